@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Chat, Profile, FriendRequest
+from .models import Chat, Profile, FriendRequest, Conversation, ConversationParticipant
 
 # Register your models here.
 class ChatAdmin(admin.ModelAdmin):
@@ -24,6 +24,21 @@ class FriendRequestAdmin(admin.ModelAdmin):
 
     
 
+class ConversationAdmin(admin.ModelAdmin):
+    list_display = ['user_one', 'user_two', 'last_message', 'last_activity', 'created_at']
+    search_fields = ['user_one__username', 'user_two__username']
+
+
+
+class ConversationParticipantAdmin(admin.ModelAdmin):
+    list_display = ['conversation', 'user', 'unread_count', 'last_read_message', 'last_read_at']
+    search_fields = ['user__username']
+
+
+    
+
 admin.site.register(Chat, ChatAdmin)    
 admin.site.register(Profile, ProfileAdmin)    
-admin.site.register(FriendRequest, FriendRequestAdmin)    
\ No newline at end of file
+admin.site.register(FriendRequest, FriendRequestAdmin)    
+admin.site.register(Conversation, ConversationAdmin)    
+admin.site.register(ConversationParticipant, ConversationParticipantAdmin)    
\ No newline at end of file
@@ -30,7 +30,12 @@ class CookieJWTAuthentication(BaseMiddleware):
         scope["cookies"] = cookies
 
         # Try cookies first, then query string
-        token = cookies.get("access_token") or cookies.get("jwt")
+        token = (
+            cookies.get("access_token") or
+            cookies.get("access") or
+            cookies.get("token") or
+            cookies.get("jwt")
+        )
         if not token:
             query_string = scope.get("query_string", b"").decode()
             if query_string:
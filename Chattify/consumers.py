@@ -1,18 +1,24 @@
 from channels.generic.websocket import AsyncWebsocketConsumer
-from asgiref.sync import sync_to_async
-import json
+import asyncio
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.utils.timezone import now
+from .models import Chat, Conversation
+from .write_behind import write_behind
+from django.db import transaction, IntegrityError
 from django.core.cache import cache
-from .models import Chat, FriendRequest
 from django.core.files.base import ContentFile
 import base64
-from django.db.models import Q
 import uuid
 from django.contrib.auth.models import AnonymousUser
 import logging
-from rest_framework_simplejwt.tokens import AccessToken
-import urllib.parse
+from handlers.utils.friends_cache import aget_friends
+from handlers.utils.presence import presence, presence_broadcaster
+from handlers.utils.pagination import paginate_messages, conversation_querysets, encode_cursor, InvalidCursor
+from handlers.utils.frames import negotiate
+from handlers.utils.renderers import dumps
+from handlers.utils.db_executor import db_sync_to_async
+from .serializers import serialize_chat
 
 
 logger = logging.getLogger(__name__)
@@ -25,7 +31,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
         logger.info("NEW WEBSOCKET CONNECTION ATTEMPT")
         logger.info("=" * 50)
         
-        # Get authenticated user from cookies
+        # Get the user authenticated by the middleware from the cookie or query string token
         self.user = await self.get_user()
         
         logger.info(f"User object: {self.user}")
@@ -42,14 +48,22 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
         self.message_count = 0
         self.sender = self.user
+        self.pending_deliveries = {}
+        self.unsaved_deliveries = []
+        self.delivery_flush_task = None
+        self.typing = {}
+        self.synced_uuids = set()
+        self.friends = {}
+        self.sync_generation = 0
         
         # Create a personal channel for this user to receive all their messages
         self.user_channel = f"user_{self.user.username}"
         
         logger.info(f"User {self.sender.username} connecting to personal channel {self.user_channel}")
 
-        # Accept WebSocket connection
-        await self.accept()
+        # Accept WebSocket connection, in MessagePack if the client asked for it
+        self.frames = negotiate(self.scope.get('subprotocols'))
+        await self.accept(subprotocol=self.frames.subprotocol)
 
         # Add user to their personal channel
         await self.channel_layer.group_add(
@@ -57,149 +71,119 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
         
-        # Update user status to online
-        cache.set(f"user_status_{self.user.username}", "Online", timeout=None)
-
-        # Get all friends and add this user to their chat rooms
-        friends = await self.get_friends_list(self.user)
+        # Register this connection; the user only comes online with their first one
+        live_connections = await presence.atouch(self.user.username, self.channel_name)
+        self.heartbeat_task = asyncio.create_task(self.heartbeat())
+
+        # Recipient username -> user id for everyone this connection may talk to, kept
+        # current by friendship_changed events; only the legacy delivery mode joins a
+        # room per friend
+        self.friends = {username: friend_id for friend_id, username in (await aget_friends(self.user.id)).items()}
+        friends = list(self.friends)
         
-        for friend_username in friends:
-            # Create room name for each friend
-            usernames = sorted([self.user.username, friend_username])
-            room_name = f"chat_{usernames[0]}_{usernames[1]}"
-            
-            # Join each chat room
-            await self.channel_layer.group_add(room_name, self.channel_name)
+        if settings.CHAT_ROOM_PER_PAIR:
+            for friend_username in friends:
+                room_name = Conversation.room_name(self.user.username, friend_username)
+                await self.channel_layer.group_add(room_name, self.channel_name)
             
-            # Notify friend that this user is online
-            await self.channel_layer.group_send(
-                f"user_{friend_username}",
-                {
-                    'type': 'user_status',
-                    'username': self.user.username,
-                    'status': 'Online',
-                }
-            )
+        # Notify friends that this user is online (debounced and batched per worker)
+        if live_connections == 1:
+            await presence_broadcaster.online(self.user.username, friends)
 
         # Send friends' online status to this user
         friends_status = await self.get_friends_online_status(self.user)
         await self.send_friends_status(friends_status)
 
     async def get_user(self):
-        """Retrieve user from JWT token in cookies or query string."""
-        try:
-            # Debug: Log all cookies
-            cookies = self.scope.get('cookies', {})
-            logger.debug(f"Available cookies: {list(cookies.keys())}")
-            
-            # Try different cookie names
-            token_key = (
-                cookies.get('access_token') or 
-                cookies.get('access') or 
-                cookies.get('token') or
-                cookies.get('jwt')
-            )
-
-            # Fallback to query string
-            if not token_key:
-                query_string = self.scope.get("query_string", b"").decode()
-                logger.debug(f"Query string: {query_string}")
-                query_params = urllib.parse.parse_qs(query_string)
-                token_key = query_params.get('token', [None])[0]
+        """The user CookieJWTAuthentication (Chattify.auth_middleware) put in the scope."""
+        return self.scope.get('user') or AnonymousUser()
 
-            if not token_key:
-                logger.warning(f"No access token found. Cookies: {list(cookies.keys())}")
-                return AnonymousUser()
-
-            logger.debug(f"Token found: {token_key[:20]}...")
-            
-            # Validate and decode token
-            access_token = AccessToken(token_key)
-            
-            # Get user from database
-            user = await sync_to_async(User.objects.get)(id=access_token['user_id'])
-            logger.info(f"User authenticated: {user.username}")
-            return user
-
-        except Exception as e:
-            logger.error(f"Authentication error: {str(e)}", exc_info=True)
-            return AnonymousUser()
-
-    @sync_to_async
-    def get_friends_list(self, user):
-        """Get list of friend usernames."""
-        friends = FriendRequest.objects.filter(
-            Q(is_accepted=True) & (Q(from_user=user) | Q(to_user=user))
-        )
-        
-        friend_usernames = []
-        for friend_request in friends:
-            friend = friend_request.to_user if friend_request.from_user == user else friend_request.from_user
-            friend_usernames.append(friend.username)
-        
-        return friend_usernames
-
-    @sync_to_async
-    def get_friends_online_status(self, user):
+    async def get_friends_online_status(self, user):
         """Fetch the online status of accepted friends."""
-        friends = FriendRequest.objects.filter(
-            Q(is_accepted=True) & (Q(from_user=user) | Q(to_user=user))
-        )
+        return await presence.astatuses(self.friends)
 
-        friends_statuses = {}
-
-        for friend_request in friends:
-            friend = friend_request.to_user if friend_request.from_user == user else friend_request.from_user
-            status = cache.get(f"user_status_{friend.username}", "Offline")
-            friends_statuses[friend.username] = status
-
-        return friends_statuses
+    async def heartbeat(self):
+        """Keep this connection's presence entry alive while the socket is open."""
+        while True:
+            await asyncio.sleep(settings.PRESENCE_HEARTBEAT_INTERVAL)
+            try:
+                await presence.atouch(self.user.username, self.channel_name)
+            except Exception as e:
+                logger.error(f"Presence heartbeat failed: {e}")
 
     async def send_friends_status(self, friends_statuses):
         """Send the online status of all friends to the frontend."""
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'type': 'friends_status',
             'friends_statuses': friends_statuses
-        }))
+        })
+
+    async def friends_status_delta(self, event):
+        """Batched presence changes; only the friends whose status changed are included."""
+        await self.send_frame({
+            'type': 'friends_status',
+            'friends_statuses': event['friends_statuses'],
+            'delta': True,
+        })
 
     async def user_status(self, event):
         """Handle user status updates."""
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'type': 'user_status',
             'username': event['username'],
             'status': event['status'],
-        }))
+        })
 
     async def disconnect(self, close_code):
         """Handle WebSocket disconnection."""
         if hasattr(self, 'user') and hasattr(self, 'user_channel'):
+            # Report whatever was delivered before the socket went away
+            if self.delivery_flush_task:
+                self.delivery_flush_task.cancel()
+                self.delivery_flush_task = None
+            await self.flush_deliveries()
+
+            # Whoever saw this user typing should see them stop
+            for recipient_username in list(getattr(self, 'typing', {})):
+                await self.stop_typing(recipient_username)
+
             # Remove from personal channel
             await self.channel_layer.group_discard(self.user_channel, self.channel_name)
 
-            # Update user status to offline
-            cache.set(f"user_status_{self.user.username}", "Offline", timeout=None)
+            # Drop this connection; the user stays online while another one is live
+            if getattr(self, 'heartbeat_task', None):
+                self.heartbeat_task.cancel()
+            live_connections = await presence.aremove(self.user.username, self.channel_name)
 
-            # Notify all friends that this user is offline
-            friends = await self.get_friends_list(self.user)
-            for friend_username in friends:
-                # Notify each friend
-                await self.channel_layer.group_send(
-                    f"user_{friend_username}",
-                    {
-                        'type': 'user_status',
-                        'username': self.user.username,
-                        'status': 'Offline',
-                    }
-                )
-                
-                # Leave chat rooms
-                usernames = sorted([self.user.username, friend_username])
-                room_name = f"chat_{usernames[0]}_{usernames[1]}"
-                await self.channel_layer.group_discard(room_name, self.channel_name)
+            # Notify all friends that this user is offline, unless they come back
+            # within the grace window
+            friends = list(self.friends)
+            if not live_connections:
+                await presence_broadcaster.offline(self.user.username, friends)
+
+            # Leave chat rooms
+            if settings.CHAT_ROOM_PER_PAIR:
+                for friend_username in friends:
+                    room_name = Conversation.room_name(self.user.username, friend_username)
+                    await self.channel_layer.group_discard(room_name, self.channel_name)
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         try:
-            data = json.loads(text_data)
+            data = self.frames.decode(text_data, bytes_data)
+
+            if data.get('type') == 'mark_read':
+                await self.mark_read(data)
+                return
+
+            if data.get('type') == 'sync':
+                await self.sync_missed_messages(data.get('cursors') or {})
+                return
+
+            if data.get('type') == 'heartbeat':
+                await presence.atouch(self.user.username, self.channel_name)
+                await self.send_frame({'type': 'heartbeat'})
+                return
+
             message = (data.get('message') or '').strip()
             media = data.get('media')
             typing_status = data.get('typing', False)
@@ -209,20 +193,14 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 await self.send_error('Recipient username is required')
                 return
 
-            # Handle typing indicator
+            # Handle typing indicator; only started/stopped transitions go out
             if 'typing' in data:
-                # Create room name
-                usernames = sorted([self.sender.username, recipient_username])
-                room_name = f"chat_{usernames[0]}_{usernames[1]}"
-                
-                await self.channel_layer.group_send(
-                    room_name,
-                    {
-                        'type': 'show_typing',
-                        'typing': typing_status,
-                        'loggedInUser': self.sender.username,
-                    }
-                )
+                if recipient_username not in self.friends:
+                    return
+                if typing_status:
+                    await self.start_typing(recipient_username)
+                else:
+                    await self.stop_typing(recipient_username)
                 return 
 
             # Validate message or media exists
@@ -230,104 +208,507 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 await self.send_error('You must send either a message or media')
                 return
 
-            # Handle media upload
-            media_file = None
-            if media:
-                media_file = await self.save_media_async(media)
-                if not media_file:
-                    await self.send_error('Invalid media file')
+            # Clients may pick the message UUID themselves so that retries are idempotent
+            message_uuid = None
+            if data.get('message_uuid'):
+                try:
+                    message_uuid = uuid.UUID(str(data['message_uuid']))
+                except ValueError:
+                    await self.send_error('Invalid message_uuid')
+                    return
+                if not await self.claim_message_uuid(message_uuid):
                     return
 
-            # Get recipient
-            recipient = await self.get_recipient_async(recipient_username)
-            if not recipient:
-                await self.send_error('Recipient does not exist')
-                return
+            delivered = False
+            try:
+                delivered = await self.send_chat_message(
+                    recipient_username, message, media, message_uuid, data.get('media_type')
+                )
+            finally:
+                # Let the client retry a send that did not go through
+                if message_uuid and not delivered:
+                    await cache.adelete(self.message_dedupe_key(message_uuid))
+        except Exception as e:
+            logger.error(f"Error in receive: {e}")
+            await self.send_error("An unexpected error occurred.")
 
-            # Save message to database
-            message_obj = await self.save_message_async(
-                self.sender, recipient, message, media_file
+    async def send_chat_message(self, recipient_username, message, media, message_uuid=None, media_type=None):
+        """Store a message, acknowledge it to the sender and publish it. False if it was rejected."""
+        # Only friends can be messaged
+        recipient = self.get_friend(recipient_username)
+        if not recipient:
+            await self.send_error('You can only send messages to your friends')
+            return False
+
+        # Handle media upload
+        media_file = None
+        if media:
+            media_file = await self.save_media_async(media, media_type)
+            if not media_file:
+                await self.send_error('Invalid media file')
+                return False
+
+        # Save message to database. In write-behind mode text messages are only
+        # journaled here and written in batches; media still goes straight to storage.
+        if settings.CHAT_WRITE_BEHIND and not media_file:
+            message_obj = Chat(
+                message_id=message_uuid or uuid.uuid4(),
+                user=self.sender,
+                recipient=recipient,
+                message=message,
+                sent_at=now(),
+            )
+            await write_behind.submit(message_obj)
+            duplicate = False
+        else:
+            message_obj, duplicate = await self.save_message_async(
+                self.sender, recipient, message, media_file, message_uuid
             )
 
-            # Create room name for this chat
-            usernames = sorted([self.sender.username, recipient_username])
-            room_name = f"chat_{usernames[0]}_{usernames[1]}"
+        ack = {
+            'message_uuid': str(message_obj.message_id),
+            'message_id': message_obj.id,
+            'sent_at': message_obj.sent_at.isoformat(),
+            'cursor': encode_cursor(message_obj.sent_at, message_obj.id) if message_obj.id else None,
+        }
+        if message_uuid:
+            await cache.aset(self.message_dedupe_key(message_uuid), ack, timeout=settings.CHAT_MESSAGE_DEDUPE_TTL)
+        await self.send_ack(ack, duplicate)
+        if duplicate:
+            return True
+
+        # Broadcast message to both users in the chat. The frame is encoded once here;
+        # receiving connections only append their own loggedInUser and counter.
+        event = {
+            'type': 'chat_message',
+            'user': self.sender.username,
+            'recipient': recipient.username,
+            'message_id': message_obj.id,
+            'message_uuid': ack['message_uuid'],
+            'body': dumps({
+                'type': 'chat_message',
+                'message': message,
+                'media': message_obj.media.url if message_obj.media else None,
+                'user': self.sender.username,
+                'recipient': recipient.username,
+                **ack,
+            }).decode(),
+        }
+        for group in self.message_groups(recipient.username):
+            await self.channel_layer.group_send(group, event)
+        return True
+
+    def message_dedupe_key(self, message_uuid):
+        return f"chat_message_{self.sender.id}_{message_uuid}"
+
+    async def claim_message_uuid(self, message_uuid):
+        """
+        Reserve a client supplied message UUID. A retry of a message that is already
+        stored gets the original ack again, one that is still being stored is dropped.
+        """
+        key = self.message_dedupe_key(message_uuid)
+        if await cache.aadd(key, None, timeout=settings.CHAT_MESSAGE_DEDUPE_TTL):
+            return True
+
+        ack = await cache.aget(key)
+        if ack:
+            await self.send_ack(ack, duplicate=True)
+        return False
+
+    async def send_ack(self, ack, duplicate=False):
+        """Confirm a stored message to the sender without waiting for the broadcast echo."""
+        await self.send_frame({
+            'type': 'ack',
+            **ack,
+            'duplicate': duplicate,
+        })
+
+    def message_groups(self, recipient_username):
+        """
+        Groups a message between the sender and `recipient_username` is published to:
+        the recipient's personal group plus the sender's (their other devices and the
+        echo to this one), or the shared pair room in legacy CHAT_ROOM_PER_PAIR mode.
+        """
+        if settings.CHAT_ROOM_PER_PAIR:
+            return [Conversation.room_name(self.sender.username, recipient_username)]
+        return [f"user_{recipient_username}", self.user_channel]
+
+    async def start_typing(self, recipient_username):
+        """
+        Mark this connection as typing to `recipient_username`. Only the first frame is
+        broadcast; later ones just push back the automatic stop, which fires after
+        TYPING_TIMEOUT seconds without a typing frame. At most TYPING_MAX_CONVERSATIONS
+        conversations are tracked per connection, frames for others are dropped.
+        """
+        deadline = asyncio.get_running_loop().time() + settings.TYPING_TIMEOUT
+        state = self.typing.get(recipient_username)
+        if state:
+            state['deadline'] = deadline
+            return
 
-            # Broadcast message to both users in the chat
-            await self.channel_layer.group_send(
-                room_name,
-                {
-                    'type': 'chat_message',
-                    'message': message,
-                    'media': message_obj.media.url if message_obj.media else None,
-                    'user': self.sender.username,
-                    'recipient': recipient.username,
-                    'message_id': message_obj.id,
-                    'sent_at': message_obj.sent_at.isoformat(),
-                }
-            )
-        except Exception as e:
-            logger.error(f"Error in receive: {e}")
-            await self.send_error("An unexpected error occurred.")
+        if len(self.typing) >= settings.TYPING_MAX_CONVERSATIONS:
+            return
+
+        self.typing[recipient_username] = {
+            'deadline': deadline,
+            'task': asyncio.create_task(self.stop_typing_later(recipient_username)),
+        }
+        await self.broadcast_typing(recipient_username, True)
+
+    async def stop_typing(self, recipient_username):
+        state = self.typing.pop(recipient_username, None)
+        if not state:
+            return
+        state['task'].cancel()
+        await self.broadcast_typing(recipient_username, False)
+
+    async def stop_typing_later(self, recipient_username):
+        loop = asyncio.get_running_loop()
+        while True:
+            state = self.typing.get(recipient_username)
+            if not state:
+                return
+            remaining = state['deadline'] - loop.time()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(remaining)
+
+        self.typing.pop(recipient_username, None)
+        await self.broadcast_typing(recipient_username, False)
+
+    async def broadcast_typing(self, recipient_username, typing):
+        # Only the other side needs to see it
+        group = (
+            Conversation.room_name(self.sender.username, recipient_username)
+            if settings.CHAT_ROOM_PER_PAIR else f"user_{recipient_username}"
+        )
+        await self.channel_layer.group_send(
+            group,
+            {
+                'type': 'show_typing',
+                'typing': typing,
+                'loggedInUser': self.sender.username,
+            }
+        )
 
     async def show_typing(self, event):
         """Handle and broadcast typing status."""
         username = event['loggedInUser']
         typing = event['typing']
 
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'type': 'typing',
             'loggedInUser': username,
             'typing': typing,
-        }))
+        })
 
     async def chat_message(self, event):
         """Handle and broadcast chat messages."""
+        if event.get('message_uuid') in self.synced_uuids:
+            # Already sent by the catch-up that ran while this event was queued
+            return
+
         self.message_count += 1
 
-        await self.send(text_data=json.dumps({
-            'type': 'chat_message',
-            'message': event['message'],
-            'message_id': event['message_id'],
-            'media': event.get('media'),
-            'user': event['user'],
-            'recipient': event['recipient'],
-            'sent_at': event['sent_at'],
+        await self.send(**self.frames.encode_with(event['body'], {
             'loggedInUser': self.sender.username,
             'incomingMessageCount': self.message_count,
         }))
 
-    @sync_to_async
-    def save_message_async(self, user, recipient, message, media=None):
-        return Chat.objects.create(
-            user=user,
-            recipient=recipient,
-            message=message,
-            media=media,
-            sent_at=now(),
+        if event['recipient'] == self.user.username and event.get('message_uuid'):
+            await self.queue_delivery(event['user'], event['message_id'], event['message_uuid'])
+
+    async def sync_missed_messages(self, cursors):
+        """
+        Catch-up after a reconnect. `cursors` maps friend usernames to the cursor of the
+        last message the client has; everything newer is sent oldest first in
+        `sync_messages` frames of CHAT_SYNC_BATCH_SIZE, followed by `sync_complete`.
+        A conversation with more than CHAT_SYNC_MAX_MESSAGES missed messages is cut
+        short and flagged `truncated` so the client can reload it over HTTP instead.
+
+        Events are handled one at a time, so live messages published meanwhile wait in
+        the channel queue. Until the `sync_done` marker sent behind them comes back,
+        those already included in the catch-up are dropped.
+        """
+        if settings.CHAT_WRITE_BEHIND and write_behind.buffer:
+            await write_behind.flush()
+
+        self.sync_generation += 1
+        conversations = {}
+
+        for friend_username, cursor in cursors.items():
+            friend_id = self.friends.get(friend_username)
+            if friend_id is None or not cursor:
+                continue
+
+            sent = 0
+            truncated = False
+            while True:
+                try:
+                    messages, cursor, has_more = await self.load_missed_messages_async(friend_id, cursor)
+                except InvalidCursor as e:
+                    await self.send_error(str(e))
+                    break
+
+                if messages:
+                    await self.send_frame({
+                        'type': 'sync_messages',
+                        'friend': friend_username,
+                        'messages': messages,
+                        'cursor': cursor,
+                        'has_more': has_more,
+                    })
+
+                for message in messages:
+                    if not message['message_id']:
+                        continue
+                    message_uuid = str(message['message_id'])
+                    self.synced_uuids.add(message_uuid)
+                    if message['recipient'] == self.user.username and not message['delivered_at']:
+                        await self.queue_delivery(message['user'], message['id'], message_uuid)
+
+                sent += len(messages)
+                if not has_more:
+                    break
+                if sent >= settings.CHAT_SYNC_MAX_MESSAGES:
+                    truncated = True
+                    break
+
+            conversations[friend_username] = {'cursor': cursor, 'truncated': truncated}
+
+        await self.send_frame({
+            'type': 'sync_complete',
+            'conversations': conversations,
+        })
+        await self.channel_layer.send(self.channel_name, {
+            'type': 'sync_done',
+            'generation': self.sync_generation,
+        })
+
+    async def sync_done(self, event):
+        # Every live event queued during the catch-up has been handled by now
+        if event['generation'] == self.sync_generation:
+            self.synced_uuids.clear()
+
+    async def queue_delivery(self, sender_username, message_id, message_uuid):
+        """Collect delivered messages so they are written and reported in batches."""
+        self.pending_deliveries.setdefault(sender_username, []).append((message_id, message_uuid))
+
+        pending_count = sum(len(messages) for messages in self.pending_deliveries.values())
+        if pending_count >= settings.DELIVERY_RECEIPT_BATCH_SIZE:
+            await self.flush_deliveries()
+        elif self.delivery_flush_task is None:
+            self.delivery_flush_task = asyncio.create_task(self.flush_deliveries_later())
+
+    async def flush_deliveries_later(self):
+        await asyncio.sleep(settings.DELIVERY_RECEIPT_FLUSH_INTERVAL)
+        self.delivery_flush_task = None
+        await self.flush_deliveries()
+
+    async def flush_deliveries(self):
+        """Stamp delivered_at with one UPDATE and send each sender a single receipt."""
+        pending, self.pending_deliveries = self.pending_deliveries, {}
+        if not pending and not self.unsaved_deliveries:
+            return
+
+        try:
+            if settings.CHAT_WRITE_BEHIND and write_behind.buffer:
+                # Messages sent through this worker may not be stored yet
+                await write_behind.flush()
+
+            delivered_at = now()
+            if pending:
+                self.unsaved_deliveries.append((
+                    [message_uuid for messages in pending.values() for _, message_uuid in messages],
+                    delivered_at,
+                    0,
+                ))
+            await self.save_deliveries()
+
+            for sender_username, messages in pending.items():
+                await self.channel_layer.group_send(
+                    f"user_{sender_username}",
+                    {
+                        'type': 'delivery_receipt',
+                        'recipient': self.user.username,
+                        'message_ids': [message_id for message_id, _ in messages],
+                        'message_uuids': [message_uuid for _, message_uuid in messages],
+                        'delivered_at': delivered_at.isoformat(),
+                    }
+                )
+        except Exception as e:
+            logger.error(f"Error flushing delivery receipts: {e}")
+
+    async def save_deliveries(self):
+        """
+        Write the queued delivered_at stamps. With write-behind on, a delivered message
+        may still be buffered, on this worker or another one, so UUIDs that matched no
+        row are tried again on the next flush, up to DELIVERY_RECEIPT_MAX_ATTEMPTS times.
+        The retry can outlive the connection; it only writes, nothing is sent.
+        """
+        unsaved, self.unsaved_deliveries = self.unsaved_deliveries, []
+        for message_uuids, delivered_at, attempts in unsaved:
+            missing = await self.save_deliveries_async(message_uuids, delivered_at)
+            if not missing or not settings.CHAT_WRITE_BEHIND:
+                continue
+            if attempts + 1 >= settings.DELIVERY_RECEIPT_MAX_ATTEMPTS:
+                logger.warning(f"Dropping delivered_at for {len(missing)} messages that were never stored")
+                continue
+            self.unsaved_deliveries.append((missing, delivered_at, attempts + 1))
+
+        if self.unsaved_deliveries and self.delivery_flush_task is None:
+            self.delivery_flush_task = asyncio.create_task(self.flush_deliveries_later())
+
+    async def delivery_receipt(self, event):
+        """Tell the sender which of their messages reached the recipient."""
+        await self.send_frame({
+            'type': 'delivery_receipt',
+            'recipient': event['recipient'],
+            'message_ids': event['message_ids'],
+            'message_uuids': event['message_uuids'],
+            'delivered_at': event['delivered_at'],
+        })
+
+    async def mark_read(self, data):
+        """Mark a conversation as read up to a message and send the friend one receipt."""
+        friend = self.get_friend(data.get('friend') or '')
+        if not friend or not data.get('message_id'):
+            await self.send_error('friend and message_id are required')
+            return
+
+        result = await db_sync_to_async(Conversation.mark_read)(self.user, friend, data['message_id'])
+        if result is None:
+            await self.send_error('Message not available')
+            return
+
+        message, updated, read_at = result
+        if updated:
+            await self.channel_layer.group_send(
+                f"user_{friend.username}",
+                {
+                    'type': 'read_receipt',
+                    'reader': self.user.username,
+                    'message_id': message.id,
+                    'read_at': read_at.isoformat(),
+                }
+            )
+
+    async def read_receipt(self, event):
+        """Tell the sender the recipient has read their messages up to message_id."""
+        await self.send_frame({
+            'type': 'read_receipt',
+            'reader': event['reader'],
+            'message_id': event['message_id'],
+            'read_at': event['read_at'],
+        })
+
+    @db_sync_to_async
+    def save_message_async(self, user, recipient, message, media=None, message_uuid=None):
+        """Returns (chat, duplicate); duplicate when `message_uuid` was already stored."""
+        try:
+            with transaction.atomic():
+                chat = Chat.objects.create(
+                    message_id=message_uuid or uuid.uuid4(),
+                    user=user,
+                    recipient=recipient,
+                    message=message,
+                    media=media,
+                    sent_at=now(),
+                )
+                Conversation.record_message(chat)
+        except IntegrityError:
+            # A retry the dedupe cache did not catch; the unique message_id did
+            existing = Chat.objects.filter(message_id=message_uuid, user=user).first() if message_uuid else None
+            if existing is None:
+                raise
+            return existing, True
+        return chat, False
+
+    @db_sync_to_async
+    def load_missed_messages_async(self, friend_id, cursor):
+        """One batch of messages newer than `cursor`, oldest first, with the next cursor."""
+        messages = conversation_querysets(
+            Chat.objects.select_related('user', 'recipient'), self.user.id, friend_id
+        )
+        page = paginate_messages(messages, after=cursor, limit=settings.CHAT_SYNC_BATCH_SIZE)
+        return (
+            [serialize_chat(message) for message in reversed(page['items'])],
+            page['cursors']['after'],
+            page['has_more'],
         )
 
-    @sync_to_async
-    def save_media_async(self, media):
+    @db_sync_to_async
+    def save_deliveries_async(self, message_uuids, delivered_at):
+        """Stamp delivered_at on the messages and return the UUIDs that are not stored."""
+        message_uuids = {str(message_uuid) for message_uuid in message_uuids}
+        updated = Chat.objects.filter(
+            message_id__in=message_uuids, delivered_at__isnull=True
+        ).update(delivered_at=delivered_at)
+        if updated == len(message_uuids):
+            return []
+
+        stored = {
+            str(message_uuid) for message_uuid in
+            Chat.objects.filter(message_id__in=message_uuids).values_list('message_id', flat=True)
+        }
+        return sorted(message_uuids - stored)
+
+    @db_sync_to_async
+    def save_media_async(self, media, media_type=None):
+        """Media arrives as a base64 data URL, or as raw bytes plus `media_type` in binary frames."""
         try:
-            format, imgstr = media.split(';base64,')
-            ext = format.split('/')[-1]
+            if isinstance(media, bytes):
+                ext = media_type.split('/')[-1]
+                content = media
+            else:
+                format, imgstr = media.split(';base64,')
+                ext = format.split('/')[-1]
+                content = base64.b64decode(imgstr)
             filename = f"{now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex}.{ext}"
-            file_data = ContentFile(base64.b64decode(imgstr), name=filename)
+            file_data = ContentFile(content, name=filename)
             return file_data
         except Exception as e:
             logger.error(f"Error saving media: {e}")
             return None
 
+    async def send_frame(self, payload):
+        """Send a payload in the encoding negotiated on connect."""
+        await self.send(**self.frames.encode(payload))
+
     async def send_error(self, error_message):
-        await self.send(text_data=json.dumps({'error': error_message}))
+        await self.send_frame({'error': error_message})
 
     async def get_room_group_name(self, sender_username, recipient_username):
         return f"{min(sender_username, recipient_username)}_{max(sender_username, recipient_username)}"
 
-    @sync_to_async
-    def get_recipient_async(self, recipient_username):
-        try:
-            return User.objects.get(username=recipient_username)
-        except User.DoesNotExist:
-            return None
\ No newline at end of file
+    def get_friend(self, username):
+        """
+        A friend from the map loaded on connect, without a query. The User instance
+        only carries id and username, enough for foreign keys and filters; it must
+        never be saved. None if `username` is not a friend.
+        """
+        friend_id = self.friends.get(username)
+        if friend_id is None:
+            return None
+        return User(id=friend_id, username=username)
+
+    async def friendship_changed(self, event):
+        """A friendship was accepted or removed over the REST API; update the friend map."""
+        friend_username = event['friend']
+        room_name = Conversation.room_name(self.user.username, friend_username)
+
+        if event['status'] == 'accepted':
+            self.friends[friend_username] = event['friend_id']
+            if settings.CHAT_ROOM_PER_PAIR:
+                await self.channel_layer.group_add(room_name, self.channel_name)
+        else:
+            self.friends.pop(friend_username, None)
+            await self.stop_typing(friend_username)
+            if settings.CHAT_ROOM_PER_PAIR:
+                await self.channel_layer.group_discard(room_name, self.channel_name)
+
+        await self.send_frame({
+            'type': 'friendship_changed',
+            'friend': friend_username,
+            'status': event['status'],
+        })
\ No newline at end of file
@@ -0,0 +1,21 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import autodiscover_modules
+
+from handlers.utils.tasks import TaskWorker
+
+
+class Command(BaseCommand):
+    help = "Run background tasks queued with handlers.utils.tasks.enqueue()."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--burst", action="store_true",
+            help="Exit once the queue is empty instead of waiting for new tasks.",
+        )
+
+    def handle(self, *args, **options):
+        # Registers the tasks defined in each app's tasks module
+        autodiscover_modules("tasks")
+        asyncio.run(TaskWorker(burst=options["burst"]).run())
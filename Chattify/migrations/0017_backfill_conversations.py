@@ -0,0 +1,57 @@
+from django.db import migrations
+
+
+def backfill_conversations(apps, schema_editor):
+    Chat = apps.get_model('Chattify', 'Chat')
+    FriendRequest = apps.get_model('Chattify', 'FriendRequest')
+    Conversation = apps.get_model('Chattify', 'Conversation')
+    ConversationParticipant = apps.get_model('Chattify', 'ConversationParticipant')
+
+    pairs = {}
+
+    for from_user_id, to_user_id in FriendRequest.objects.filter(is_accepted=True).values_list('from_user_id', 'to_user_id'):
+        if from_user_id != to_user_id:
+            pairs.setdefault(tuple(sorted([from_user_id, to_user_id])), {"last": None, "unread": {}})
+
+    messages = (
+        Chat.objects.exclude(user=None).exclude(recipient=None)
+        .order_by('sent_at', 'id')
+        .values_list('id', 'user_id', 'recipient_id', 'sent_at', 'is_read')
+    )
+    for chat_id, user_id, recipient_id, sent_at, is_read in messages.iterator(chunk_size=2000):
+        pair = pairs.setdefault(tuple(sorted([user_id, recipient_id])), {"last": None, "unread": {}})
+        pair["last"] = (chat_id, sent_at)
+        if not is_read:
+            pair["unread"][recipient_id] = pair["unread"].get(recipient_id, 0) + 1
+
+    for (user_one_id, user_two_id), pair in pairs.items():
+        last_id, last_activity = pair["last"] or (None, None)
+        conversation = Conversation.objects.create(
+            user_one_id=user_one_id,
+            user_two_id=user_two_id,
+            last_message_id=last_id,
+            last_activity=last_activity,
+        )
+        ConversationParticipant.objects.bulk_create([
+            ConversationParticipant(
+                conversation=conversation,
+                user_id=user_id,
+                unread_count=pair["unread"].get(user_id, 0),
+            )
+            for user_id in (user_one_id, user_two_id)
+        ])
+
+
+def remove_conversations(apps, schema_editor):
+    apps.get_model('Chattify', 'Conversation').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Chattify', '0016_conversation'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_conversations, remove_conversations),
+    ]
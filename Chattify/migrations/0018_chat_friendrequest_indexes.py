@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:21
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Chattify', '0017_backfill_conversations'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chat',
+            index=models.Index(fields=['user', 'recipient', 'sent_at', 'id'], name='chat_pair_sent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chat',
+            index=models.Index(condition=models.Q(('is_deleted', False), ('is_read', False)), fields=['recipient', 'user', 'sent_at'], name='chat_unread_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='friendrequest',
+            index=models.Index(fields=['from_user', 'is_accepted', 'to_user'], name='friendrequest_from_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='friendrequest',
+            index=models.Index(fields=['to_user', 'is_accepted', 'from_user'], name='friendrequest_to_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:25
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Chattify', '0018_chat_friendrequest_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chat',
+            name='sent_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,65 @@
+from django.db import migrations
+
+# SQLite FTS5 index over Chat.message, kept in sync by triggers so every write path
+# (create, bulk_create, update, soft delete) is covered. Other databases use a
+# different search backend (see Chattify.search) and skip this migration.
+
+INDEXED = "{row}.message IS NOT NULL AND {row}.message != '' AND NOT COALESCE({row}.is_deleted, 0)"
+
+# `owners` ("u<sender id> u<recipient id>") lets a search be narrowed to the user's
+# messages inside the index instead of ranking hits from every user first.
+OWNERS = "'u' || {row}.user_id || ' u' || {row}.recipient_id"
+
+CREATE_SQL = [
+    "CREATE VIRTUAL TABLE chattify_chat_fts USING fts5(message, owners, tokenize='unicode61 remove_diacritics 2', prefix='1 2 3')",
+    f"""INSERT INTO chattify_chat_fts(rowid, message, owners)
+        SELECT id, message, {OWNERS.format(row='Chattify_chat')} FROM Chattify_chat
+        WHERE {INDEXED.format(row='Chattify_chat')}""",
+    f"""CREATE TRIGGER chattify_chat_fts_insert AFTER INSERT ON Chattify_chat
+        WHEN {INDEXED.format(row='new')}
+        BEGIN
+            INSERT INTO chattify_chat_fts(rowid, message, owners) VALUES (new.id, new.message, {OWNERS.format(row='new')});
+        END""",
+    f"""CREATE TRIGGER chattify_chat_fts_update AFTER UPDATE OF message, is_deleted, user_id, recipient_id ON Chattify_chat
+        BEGIN
+            DELETE FROM chattify_chat_fts WHERE rowid = old.id;
+            INSERT INTO chattify_chat_fts(rowid, message, owners)
+                SELECT new.id, new.message, {OWNERS.format(row='new')} WHERE {INDEXED.format(row='new')};
+        END""",
+    """CREATE TRIGGER chattify_chat_fts_delete AFTER DELETE ON Chattify_chat
+        BEGIN
+            DELETE FROM chattify_chat_fts WHERE rowid = old.id;
+        END""",
+]
+
+DROP_SQL = [
+    "DROP TRIGGER IF EXISTS chattify_chat_fts_insert",
+    "DROP TRIGGER IF EXISTS chattify_chat_fts_update",
+    "DROP TRIGGER IF EXISTS chattify_chat_fts_delete",
+    "DROP TABLE IF EXISTS chattify_chat_fts",
+]
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in CREATE_SQL:
+        schema_editor.execute(statement)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in DROP_SQL:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Chattify', '0019_alter_chat_sent_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
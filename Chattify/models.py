@@ -1,4 +1,7 @@
-from django.db import models
+import uuid
+from django.db import models, transaction
+from django.utils import timezone
+from django.db.models import F, Q
 from django.contrib.auth.models import User
 
 # Create your models here.
@@ -8,7 +11,7 @@ class Chat(models.Model):
     recipient = models.ForeignKey(User, on_delete=models.CASCADE, blank=True, null=True, related_name='recipient')
     message = models.TextField(blank=True, null=True)
     media = models.FileField(upload_to='message_images/', blank=True)
-    sent_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(default=timezone.now)
     is_deleted = models.BooleanField(default=False, null=True)
     is_read = models.BooleanField(default=False)
     read_at = models.DateTimeField(blank=True, null=True)
@@ -21,6 +24,16 @@ class Chat(models.Model):
                 name='prevent_self_message'
             )
         ]
+        indexes = [
+            # History, inbox and sync queries: (user, recipient) pair ordered by (sent_at, id).
+            models.Index(fields=['user', 'recipient', 'sent_at', 'id'], name='chat_pair_sent_idx'),
+            # Unread counts and read receipts only ever look at live, unread messages.
+            models.Index(
+                fields=['recipient', 'user', 'sent_at'],
+                name='chat_unread_idx',
+                condition=models.Q(is_read=False, is_deleted=False),
+            ),
+        ]
 
 
 class Profile(models.Model):
@@ -43,6 +56,14 @@ class FriendRequest(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     is_accepted = models.BooleanField(default=False)
     is_rejected = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            # Friend lists filter on is_accepted with from_user OR to_user; each
+            # branch of the OR is answered from one of these without touching the table.
+            models.Index(fields=['from_user', 'is_accepted', 'to_user'], name='friendrequest_from_idx'),
+            models.Index(fields=['to_user', 'is_accepted', 'from_user'], name='friendrequest_to_idx'),
+        ]
     
     def __str__(self):
         return f"{self.from_user} to {self.to_user}"
@@ -54,3 +75,132 @@ class FriendRequest(models.Model):
     def reject(self):
         self.is_rejected = True
         self.save()
+
+
+
+class Conversation(models.Model):
+    """
+    One row per pair of users. `user_one` is always the participant with the lower id,
+    so a pair maps to exactly one conversation regardless of who wrote first.
+    """
+    user_one = models.ForeignKey(User, on_delete=models.CASCADE, related_name="conversations_started")
+    user_two = models.ForeignKey(User, on_delete=models.CASCADE, related_name="conversations_joined")
+    last_message = models.ForeignKey(Chat, on_delete=models.SET_NULL, blank=True, null=True, related_name="+")
+    last_activity = models.DateTimeField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_one', 'user_two'], name='unique_conversation_pair'),
+            models.CheckConstraint(
+                check=models.Q(user_one__lt=models.F('user_two')),
+                name='conversation_ordered_pair'
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.user_one} & {self.user_two}"
+
+    @staticmethod
+    def room_name(username_a, username_b):
+        """Channel layer group shared by both participants."""
+        usernames = sorted([username_a, username_b])
+        return f"chat_{usernames[0]}_{usernames[1]}"
+
+    @classmethod
+    def get_for_pair(cls, user_a_id, user_b_id):
+        """Return the conversation between two users, creating it and its participants if needed."""
+        user_one_id, user_two_id = sorted([user_a_id, user_b_id])
+        with transaction.atomic():
+            conversation, created = cls.objects.get_or_create(user_one_id=user_one_id, user_two_id=user_two_id)
+            if created:
+                ConversationParticipant.objects.bulk_create([
+                    ConversationParticipant(conversation=conversation, user_id=user_one_id),
+                    ConversationParticipant(conversation=conversation, user_id=user_two_id),
+                ])
+        return conversation
+
+    @classmethod
+    def record_message(cls, chat):
+        """
+        Move the conversation's last message pointer to `chat` and bump the recipient's
+        unread counter. Must run in the same transaction that created the Chat row.
+        """
+        return cls.record_messages([chat])[0]
+
+    @classmethod
+    def record_messages(cls, chats):
+        """Batch form of record_message: one pointer move and one counter bump per conversation."""
+        by_pair = {}
+        for chat in chats:
+            by_pair.setdefault(tuple(sorted([chat.user_id, chat.recipient_id])), []).append(chat)
+
+        conversations = []
+        with transaction.atomic():
+            for (user_one_id, user_two_id), pair_chats in by_pair.items():
+                conversation = cls.get_for_pair(user_one_id, user_two_id)
+                latest = max(pair_chats, key=lambda chat: (chat.sent_at, chat.id))
+                cls.objects.filter(
+                    Q(last_activity__isnull=True) | Q(last_activity__lte=latest.sent_at),
+                    pk=conversation.pk,
+                ).update(last_message=latest, last_activity=latest.sent_at)
+
+                for recipient_id in (user_one_id, user_two_id):
+                    received = sum(1 for chat in pair_chats if chat.recipient_id == recipient_id)
+                    if received:
+                        ConversationParticipant.objects.filter(
+                            conversation=conversation, user_id=recipient_id
+                        ).update(unread_count=F('unread_count') + received)
+                conversations.append(conversation)
+        return conversations
+
+    @classmethod
+    def mark_read(cls, reader, friend, message_ref):
+        """
+        Mark every message `friend` sent to `reader` up to and including the referenced
+        message (pk or message UUID) as read, using a single range UPDATE.
+        Returns (message, updated_count, read_at), or None if the message is not in
+        this conversation.
+        """
+        try:
+            lookup = Q(message_id=uuid.UUID(str(message_ref)))
+        except ValueError:
+            try:
+                lookup = Q(pk=int(message_ref))
+            except (TypeError, ValueError):
+                return None
+
+        message = Chat.objects.filter(
+            lookup, (Q(user=friend) & Q(recipient=reader)) | (Q(user=reader) & Q(recipient=friend))
+        ).first()
+        if message is None:
+            return None
+
+        read_at = timezone.now()
+        with transaction.atomic():
+            unread = Chat.objects.filter(user=friend, recipient=reader, is_read=False, is_deleted=False)
+            updated = unread.filter(sent_at__lte=message.sent_at).update(is_read=True, read_at=read_at)
+
+            conversation = cls.get_for_pair(reader.id, friend.id)
+            ConversationParticipant.objects.filter(conversation=conversation, user=reader).update(
+                unread_count=unread.count(),
+                last_read_message=message,
+                last_read_at=read_at,
+            )
+        return message, updated, read_at
+
+
+class ConversationParticipant(models.Model):
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name="participants")
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="conversation_memberships")
+    unread_count = models.PositiveIntegerField(default=0)
+    last_read_message = models.ForeignKey(Chat, on_delete=models.SET_NULL, blank=True, null=True, related_name="+")
+    last_read_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['conversation', 'user'], name='unique_conversation_participant'),
+        ]
+
+    def __str__(self):
+        return f"{self.user} in {self.conversation}"
@@ -0,0 +1,120 @@
+import re
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils.html import escape
+from django.utils.module_loading import import_string
+
+from .models import Chat
+from .serializers import serialize_chat
+
+# Snippets are built with control characters as match markers, HTML-escaped and only
+# then turned into <mark> tags, so message text can never inject markup.
+MATCH_START, MATCH_END = "\x02", "\x03"
+
+
+def highlight(snippet):
+    return escape(snippet).replace(MATCH_START, "<mark>").replace(MATCH_END, "</mark>")
+
+
+class SearchBackend:
+    """
+    Message search for one user, optionally limited to the conversation with `friend`.
+    `search` returns (hits, has_more); each hit is {"message", "snippet", "rank"}.
+    """
+
+    def search(self, user, query, friend=None, limit=20, offset=0):
+        raise NotImplementedError
+
+    def _participant_filter(self, user, friend):
+        if friend is None:
+            return Q(user=user) | Q(recipient=user)
+        return (Q(user=user) & Q(recipient=friend)) | (Q(user=friend) & Q(recipient=user))
+
+    def _hits(self, ranked, limit):
+        """Load and serialize the messages for [(chat_id, snippet, rank), ...] keeping their order."""
+        has_more = len(ranked) > limit
+        ranked = ranked[:limit]
+        messages = Chat.objects.select_related('user', 'recipient').in_bulk([chat_id for chat_id, _, _ in ranked])
+        hits = [
+            {
+                "message": serialize_chat(messages[chat_id]),
+                "snippet": highlight(snippet),
+                "rank": rank,
+            }
+            for chat_id, snippet, rank in ranked
+            if chat_id in messages
+        ]
+        return hits, has_more
+
+
+class SQLiteFTSBackend(SearchBackend):
+    """Ranked search over the chattify_chat_fts FTS5 table (migration 0020)."""
+
+    def match_expression(self, query, user, friend=None):
+        terms = re.findall(r"\w+", query)
+        if not terms:
+            return None
+        # Quote every term so user input is never parsed as FTS5 syntax; the last
+        # term is a prefix so results show up while the user is still typing.
+        quoted = [f'"{term}"' for term in terms]
+        quoted[-1] += "*"
+        # The owners column narrows the match to the user's (or the pair's) messages
+        # inside the index, before anything is ranked.
+        owners = [f"owners:u{user.id}"]
+        if friend is not None:
+            owners.append(f"owners:u{friend.id}")
+        return " AND ".join(owners) + f" AND message:({' '.join(quoted)})"
+
+    def search(self, user, query, friend=None, limit=20, offset=0):
+        expression = self.match_expression(query, user, friend)
+        if expression is None:
+            return [], False
+
+        # bm25 weights: only the message column counts towards the rank.
+        sql = """
+            SELECT rowid, snippet(chattify_chat_fts, 0, %s, %s, '…', 16), bm25(chattify_chat_fts, 1.0, 0.0) AS rank
+            FROM chattify_chat_fts
+            WHERE chattify_chat_fts MATCH %s
+            ORDER BY rank
+            LIMIT %s OFFSET %s
+        """
+        params = [MATCH_START, MATCH_END, expression, limit + 1, offset]
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            ranked = cursor.fetchall()
+
+        return self._hits(ranked, limit)
+
+
+class DatabaseSearchBackend(SearchBackend):
+    """
+    Unindexed substring search for databases without an FTS index, newest first.
+    A Postgres tsvector backend can subclass SearchBackend the same way.
+    """
+
+    def search(self, user, query, friend=None, limit=20, offset=0):
+        query = query.strip()
+        if not query:
+            return [], False
+
+        rows = Chat.objects.filter(
+            self._participant_filter(user, friend),
+            message__icontains=query,
+            is_deleted=False,
+        ).order_by('-sent_at', '-id').values_list('id', 'message')[offset:offset + limit + 1]
+
+        pattern = re.compile(re.escape(query), re.IGNORECASE)
+        ranked = [
+            (chat_id, pattern.sub(lambda match: f"{MATCH_START}{match.group(0)}{MATCH_END}", message), 0)
+            for chat_id, message in rows
+        ]
+        return self._hits(ranked, limit)
+
+
+@lru_cache(maxsize=None)
+def get_search_backend():
+    return import_string(settings.CHAT_SEARCH_BACKEND)()
@@ -1,6 +1,8 @@
 from rest_framework import serializers
 from .models import Chat, Profile, FriendRequest
 from django.contrib.auth.models import User
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.files.storage import default_storage
 
 class ChatSerialzer(serializers.ModelSerializer):
     user = serializers.CharField(source="user.username")
@@ -31,3 +33,90 @@ class FriendRequestSerializer(serializers.ModelSerializer):
     class Meta:
         model = FriendRequest
         fields = ['id', 'from_user', 'to_user', 'created_at']
+
+
+# Read-only fast paths for the hot endpoints. They produce the same shape as the
+# ModelSerializers above from select_related() instances or .values() rows, without
+# DRF's per-field machinery. Datetimes and UUIDs are left to the JSON renderer.
+
+def _file_url(name):
+    return default_storage.url(name) if name else None
+
+
+def serialize_chat(chat):
+    """ChatSerialzer output for a Chat loaded with select_related('user', 'recipient')."""
+    return {
+        "id": chat.id,
+        "user": chat.user.username if chat.user_id else None,
+        "recipient": chat.recipient.username if chat.recipient_id else None,
+        "message_id": chat.message_id,
+        "message": chat.message,
+        "media": _file_url(chat.media.name),
+        "sent_at": chat.sent_at,
+        "is_deleted": chat.is_deleted,
+        "is_read": chat.is_read,
+        "read_at": chat.read_at,
+        "delivered_at": chat.delivered_at,
+    }
+
+
+CHAT_VALUES = (
+    "id", "user__username", "recipient__username", "message_id", "message", "media",
+    "sent_at", "is_deleted", "is_read", "read_at", "delivered_at",
+)
+
+
+def serialize_chat_values(row):
+    """ChatSerialzer output for a row from Chat.objects.values(*CHAT_VALUES)."""
+    return {
+        "id": row["id"],
+        "user": row["user__username"],
+        "recipient": row["recipient__username"],
+        "message_id": row["message_id"],
+        "message": row["message"],
+        "media": _file_url(row["media"]),
+        "sent_at": row["sent_at"],
+        "is_deleted": row["is_deleted"],
+        "is_read": row["is_read"],
+        "read_at": row["read_at"],
+        "delivered_at": row["delivered_at"],
+    }
+
+
+def serialize_profile(profile):
+    return {
+        "id": profile.id,
+        "user": profile.user_id,
+        "profile_picture": _file_url(profile.profile_picture.name),
+        "cover_picture": _file_url(profile.cover_picture.name),
+        "bio": profile.bio,
+        "ip_address": profile.ip_address,
+        "city": profile.city,
+        "country": profile.country,
+        "social_links": profile.social_links,
+    }
+
+
+def serialize_user(user):
+    """UserSerializer output for a User loaded with select_related('profile')."""
+    try:
+        profile = serialize_profile(user.profile)
+    except ObjectDoesNotExist:
+        profile = None
+
+    return {
+        "id": user.id,
+        "username": user.username,
+        "email": user.email,
+        "profile": profile,
+    }
+
+
+def serialize_friend_request(friend_request):
+    """FriendRequestSerializer output; select_related('from_user__profile', 'to_user__profile')."""
+    return {
+        "id": friend_request.id,
+        "from_user": serialize_user(friend_request.from_user),
+        "to_user": serialize_user(friend_request.to_user),
+        "created_at": friend_request.created_at,
+    }
@@ -0,0 +1,43 @@
+import logging
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+
+from handlers.utils.db_executor import db_sync_to_async
+from handlers.utils.get_agent import get_location
+from handlers.utils.tasks import task, download
+from .models import Profile
+
+logger = logging.getLogger(__name__)
+
+
+def save_profile_picture(profile_id, content):
+    profile = Profile.objects.filter(pk=profile_id).first()
+    if profile is None or profile.profile_picture:
+        # Deleted, or the user uploaded a picture of their own in the meantime
+        return
+    profile.profile_picture.save(f"profile_image{profile.user_id}ddwm.jpg", ContentFile(content), save=False)
+    profile.save(update_fields=['profile_picture'])
+
+
+def save_location(profile_id, ip):
+    city, country = get_location(ip)
+    Profile.objects.filter(pk=profile_id).update(city=city, country=country)
+
+
+@task("import_profile_picture")
+async def import_profile_picture(http, profile_id, url):
+    """Copy a Google account's avatar into the new user's profile after registration."""
+    try:
+        content = await download(http, url, settings.PROFILE_PICTURE_MAX_BYTES, content_type="image/")
+    except ValueError as e:
+        logger.warning(f"Not importing profile picture for profile {profile_id}: {e}")
+        return
+    await db_sync_to_async(save_profile_picture)(profile_id, content)
+
+
+@task("locate_profile")
+async def locate_profile(http, profile_id, ip):
+    """Fill in a new profile's city and country from its registration IP (GEOIP_IN_BACKGROUND)."""
+    # The GeoIP lookup reads the database file, so it runs off the event loop too
+    await db_sync_to_async(save_location)(profile_id, ip)
@@ -1,3 +1,706 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import json
+import threading
+import time
+import uuid
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock, skipIf
 
-# Create your tests here.
+import httpx
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Q
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from django.utils.module_loading import autodiscover_modules
+from channels.layers import InMemoryChannelLayer
+from channels.testing import WebsocketCommunicator
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from handlers.utils import friends_cache, google_auth
+from handlers.utils.db_executor import db_sync_to_async
+from handlers.utils.tasks import TaskWorker, enqueue
+from handlers.utils.presence import Presence, ONLINE, OFFLINE
+from handlers.utils.user_cache import user_cache, user_cache_key
+from handlers.utils.pagination import conversation_querysets
+from .consumers import ChatConsumer
+from .models import Chat, Conversation, FriendRequest, Profile
+from .search import SQLiteFTSBackend
+from .write_behind import MessageWriteBehind, journal_record
+
+try:
+    import fakeredis
+except ImportError:  # pragma: no cover - the Redis-backed tests are skipped then
+    fakeredis = None
+
+# The suite runs without Redis: the cache and channel layer live in process.
+TEST_SETTINGS = dict(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+)
+
+
+class ClearCacheMixin:
+    """Empties the cache first: friend lists are cached by user id, and ids are reused between tests."""
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+
+class FakeRedisMixin:
+    """
+    Patches each of `redis_targets` (dotted paths to get_redis / get_async_redis)
+    to return a client of one fresh fakeredis server, available as self.redis and
+    self.async_redis.
+    """
+
+    redis_targets = ()
+
+    def setUp(self):
+        super().setUp()
+        server = fakeredis.FakeServer()
+        self.redis = fakeredis.FakeRedis(server=server)
+        self.async_redis = fakeredis.aioredis.FakeRedis(server=server)
+        for target in self.redis_targets:
+            client = self.async_redis if target.endswith("get_async_redis") else self.redis
+            patcher = mock.patch(target, return_value=client)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+@override_settings(**TEST_SETTINGS)
+class QueryPlanTests(TestCase):
+    """The hot Chat and FriendRequest queries must be index searches, never full scans or sorts."""
+
+    @classmethod
+    def setUpTestData(cls):
+        users = User.objects.bulk_create([User(username=f"user{i}") for i in range(20)])
+        cls.user, cls.friend = users[0], users[1]
+        start = timezone.now() - timedelta(days=1)
+        Chat.objects.bulk_create([
+            Chat(user=users[i % 20], recipient=users[(i * 7 + 1) % 20], message=f"message {i}",
+                 sent_at=start + timedelta(seconds=i), is_read=i % 3 == 0)
+            for i in range(2000) if i % 20 != (i * 7 + 1) % 20
+        ])
+        FriendRequest.objects.bulk_create([
+            FriendRequest(from_user=users[i], to_user=users[j], is_accepted=(i + j) % 2 == 0)
+            for i in range(20) for j in range(i + 1, 20)
+        ])
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def query_plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def assertIndexed(self, queryset, allow_sort=False):
+        plan = self.query_plan(queryset)
+        for step in plan:
+            for table in (Chat._meta.db_table, FriendRequest._meta.db_table):
+                self.assertFalse(step.startswith(f"SCAN {table}"), f"full table scan: {plan}")
+            if not allow_sort:
+                self.assertNotIn("USE TEMP B-TREE", step, f"sorts the whole match: {plan}")
+
+    def test_conversation_history(self):
+        sent_at = timezone.now()
+        for queryset in conversation_querysets(Chat.objects.all(), self.user, self.friend):
+            self.assertIndexed(queryset.order_by("-sent_at", "-id")[:51])
+            self.assertIndexed(
+                queryset.filter(sent_at__lte=sent_at).filter(Q(sent_at__lt=sent_at) | Q(id__lt=10))
+                .order_by("-sent_at", "-id")[:51]
+            )
+            self.assertIndexed(
+                queryset.filter(sent_at__gte=sent_at).filter(Q(sent_at__gt=sent_at) | Q(id__gt=10))
+                .order_by("sent_at", "id")[:51]
+            )
+
+    def test_unread_messages(self):
+        unread = Chat.objects.filter(user=self.friend, recipient=self.user, is_read=False, is_deleted=False)
+        self.assertIndexed(unread.filter(sent_at__lte=timezone.now()))
+        self.assertIndexed(unread.values("id")[:1])
+
+    def test_friend_lists(self):
+        self.assertIndexed(FriendRequest.objects.filter(
+            Q(from_user=self.user, is_accepted=True) | Q(to_user=self.user, is_accepted=True)
+        ).values_list("from_user_id", "to_user_id"))
+        self.assertIndexed(FriendRequest.objects.filter(from_user=self.user, to_user=self.friend, is_accepted=False))
+        self.assertIndexed(FriendRequest.objects.filter(to_user=self.user, is_accepted=False))
+
+    def test_inbox_messages(self):
+        friend_ids = [self.friend.id, self.friend.id + 1, self.friend.id + 2]
+        # The window function has to order each pair's rows; that sort is expected,
+        # reading the table is not.
+        self.assertIndexed(
+            Chat.objects.filter(
+                Q(user=self.user, recipient_id__in=friend_ids) | Q(user_id__in=friend_ids, recipient=self.user)
+            ).order_by("sent_at", "id"),
+            allow_sort=True,
+        )
+
+
+@override_settings(**TEST_SETTINGS)
+class InboxTests(TestCase):
+    """get_messages/ must cost the same number of queries however many friends the user has."""
+
+    def setUp(self):
+        self.user = User.objects.create_user("inbox_owner")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def add_friends(self, count, messages_each=3):
+        for i in range(count):
+            friend = User.objects.create_user(f"friend{User.objects.count()}")
+            Profile.objects.create(user=friend)
+            FriendRequest.objects.create(from_user=self.user if i % 2 else friend,
+                                         to_user=friend if i % 2 else self.user, is_accepted=True)
+            for j in range(messages_each):
+                chat = Chat.objects.create(user=friend if j % 2 else self.user,
+                                           recipient=self.user if j % 2 else friend, message=f"hello {j}")
+                Conversation.record_message(chat)
+
+    def get_inbox(self, queries):
+        with self.assertNumQueries(queries):
+            response = self.client.get("/api/v1/get_messages/", {"limit": 2})
+        self.assertEqual(response.status_code, 200)
+        return response.json()["chats"]
+
+    def test_query_count_does_not_grow_with_friends(self):
+        self.add_friends(1)
+        self.assertEqual(len(self.get_inbox(4)), 1)
+
+        self.add_friends(40)
+        chats = self.get_inbox(4)
+        self.assertEqual(len(chats), 41)
+        for chat in chats:
+            self.assertEqual(len(chat["messages"]), 2)
+            self.assertIsNotNone(chat["before"])
+
+
+@override_settings(**TEST_SETTINGS)
+class FriendsCacheTests(ClearCacheMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user("cache_owner")
+        self.friend = User.objects.create_user("cache_friend")
+
+    def test_list_loaded_before_a_change_is_not_cached(self):
+        request = FriendRequest.objects.create(from_user=self.friend, to_user=self.user)
+        load_friends = friends_cache.load_friends
+
+        def accept_while_loading(user_id):
+            stale = load_friends(user_id)
+            request.accept()
+            friends_cache.invalidate_friends(self.user.id, self.friend.id)
+            return stale
+
+        with mock.patch.object(friends_cache, "load_friends", accept_while_loading):
+            self.assertEqual(friends_cache.get_friends(self.user.id), {})
+        self.assertEqual(friends_cache.get_friends(self.user.id), {self.friend.id: "cache_friend"})
+
+
+@skipIf(fakeredis is None, "fakeredis is not installed")
+@override_settings(**TEST_SETTINGS, CHAT_WRITE_BEHIND_WORKER_TIMEOUT=30)
+class WriteBehindTests(FakeRedisMixin, TransactionTestCase):
+    # Flushes run on the database thread pool, which does not see a TestCase's
+    # uncommitted transaction.
+    redis_targets = ("Chattify.write_behind.get_async_redis",)
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user("writer")
+        self.friend = User.objects.create_user("reader")
+
+    def message(self, text, recipient_id=None):
+        return Chat(message_id=uuid.uuid4(), user_id=self.user.id, recipient_id=recipient_id or self.friend.id,
+                    message=text, sent_at=timezone.now())
+
+    async def test_bad_row_is_dead_lettered_and_the_rest_stored(self):
+        worker = MessageWriteBehind()
+        await worker.submit(self.message("hello"))
+        await worker.submit(self.message("to nobody", recipient_id=self.friend.id + 100))
+        await worker.submit(self.message("still there?"))
+        await worker.flush()
+
+        stored = [chat.message async for chat in Chat.objects.order_by("id")]
+        self.assertEqual(stored, ["hello", "still there?"])
+        self.assertEqual(worker.buffer, [])
+        self.assertEqual(await self.async_redis.llen(worker.journal_key(worker.worker_id)), 0)
+
+        dead = [json.loads(record) for record in await self.async_redis.lrange("chattify:write_behind:dead", 0, -1)]
+        self.assertEqual([record["message"] for record in dead], ["to nobody"])
+        self.assertIn("error", dead[0])
+
+    @override_settings(CHAT_WRITE_BEHIND=True, CHAT_WRITE_BEHIND_FLUSH_INTERVAL=60, DELIVERY_RECEIPT_FLUSH_INTERVAL=60)
+    async def test_delivery_of_a_message_still_buffered_elsewhere(self):
+        other_worker = MessageWriteBehind()
+        chat = self.message("hello")
+        await other_worker.submit(chat)
+        self.addCleanup(other_worker.flush_task.cancel)
+
+        consumer = ChatConsumer()
+        consumer.user = self.friend
+        consumer.channel_layer = InMemoryChannelLayer()
+        consumer.pending_deliveries, consumer.unsaved_deliveries, consumer.delivery_flush_task = {}, [], None
+        await consumer.queue_delivery("writer", 1, str(chat.message_id))
+        self.addCleanup(lambda: consumer.delivery_flush_task and consumer.delivery_flush_task.cancel())
+
+        # The UPDATE matches nothing yet, so the UUID waits for the next flush
+        await consumer.flush_deliveries()
+        self.assertEqual([uuids for uuids, _, _ in consumer.unsaved_deliveries], [[str(chat.message_id)]])
+
+        await other_worker.flush()
+        await consumer.flush_deliveries()
+        self.assertEqual(consumer.unsaved_deliveries, [])
+        self.assertIsNotNone((await Chat.objects.aget(message_id=chat.message_id)).delivered_at)
+
+    async def test_only_dead_workers_journals_are_replayed(self):
+        live, dead, recovering = MessageWriteBehind(), MessageWriteBehind(), MessageWriteBehind()
+        for worker in (live, dead):
+            await worker.beat()
+            await self.async_redis.rpush(worker.journal_key(worker.worker_id),
+                                   journal_record(self.message(f"from {worker.worker_id}")))
+        await self.async_redis.zadd(dead.workers_key(), {dead.worker_id: 0})
+
+        await recovering.beat()
+        recovering.lock = asyncio.Lock()
+        await recovering.flush()
+
+        stored = [chat.message async for chat in Chat.objects.all()]
+        self.assertEqual(stored, [f"from {dead.worker_id}"])
+        self.assertEqual(await self.async_redis.exists(dead.journal_key(dead.worker_id)), 0)
+        self.assertEqual(await self.async_redis.llen(live.journal_key(live.worker_id)), 1)
+        self.assertEqual(await self.async_redis.llen(recovering.journal_key(recovering.worker_id)), 0)
+        self.assertIsNone(await self.async_redis.zscore(dead.workers_key(), dead.worker_id))
+
+        # A second replay of the same journal finds nothing to claim
+        await live.beat()
+        self.assertEqual(live.buffer, [])
+
+
+@override_settings(**TEST_SETTINGS)
+class ExportTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("exporter")
+        cls.friend = User.objects.create_user("exported")
+        Chat.objects.bulk_create([
+            Chat(user=cls.user if i % 2 else cls.friend, recipient=cls.friend if i % 2 else cls.user,
+                 message=f"{i} " + "x" * 200)
+            for i in range(1000)
+        ])
+
+    def setUp(self):
+        self.async_client.cookies["access_token"] = str(AccessToken.for_user(self.user))
+
+    async def export(self, **params):
+        response = await self.async_client.get("/api/v1/export_messages/exported/", params)
+        self.assertEqual(response.status_code, 200)
+        # Served chunk by chunk under ASGI, not collected into a list first
+        self.assertTrue(response.is_async)
+        return [chunk async for chunk in response.streaming_content]
+
+    async def test_ndjson_export_is_streamed(self):
+        chunks = await self.export()
+        self.assertGreater(len(chunks), 1)
+        lines = b"".join(chunks).splitlines()
+        self.assertEqual(len(lines), 1000)
+        self.assertTrue(json.loads(lines[-1])["message"].startswith("999 "))
+
+    async def test_gzipped_json_export(self):
+        chunks = await self.export(mode="json", compress="gzip")
+        rows = json.loads(gzip.decompress(b"".join(chunks)))
+        self.assertEqual(len(rows), 1000)
+
+
+@override_settings(**TEST_SETTINGS)
+class SearchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user, cls.friend, cls.other, cls.stranger = [
+            User.objects.create_user(name) for name in ("searcher", "pal", "other", "stranger")
+        ]
+        cls.to_friend = Chat.objects.create(user=cls.user, recipient=cls.friend, message="meeting on monday")
+        cls.to_other = Chat.objects.create(user=cls.other, recipient=cls.user, message="moving the meeting")
+        Chat.objects.create(user=cls.stranger, recipient=cls.other, message="meeting without you")
+
+    def search(self, query, friend=None):
+        hits, _ = SQLiteFTSBackend().search(self.user, query, friend=friend)
+        return [hit["message"]["message"] for hit in hits]
+
+    def test_only_the_users_messages_match(self):
+        self.assertCountEqual(self.search("meet"), ["meeting on monday", "moving the meeting"])
+        self.assertEqual(self.search("m", friend=self.other), ["moving the meeting"])
+        self.assertEqual(self.search("without"), [])
+
+    def test_index_follows_updates_and_soft_deletes(self):
+        Chat.objects.filter(pk=self.to_friend.pk).update(is_deleted=True)
+        self.assertEqual(self.search("meeting"), ["moving the meeting"])
+        Chat.objects.filter(pk=self.to_other.pk).update(recipient=self.stranger)
+        self.assertEqual(self.search("meeting"), [])
+
+
+@skipIf(fakeredis is None, "fakeredis is not installed")
+@override_settings(**TEST_SETTINGS, PRESENCE_TTL=90)
+class PresenceTests(FakeRedisMixin, TestCase):
+    redis_targets = ("handlers.utils.presence.get_redis", "handlers.utils.presence.get_async_redis")
+
+    def setUp(self):
+        super().setUp()
+        self.presence = Presence()
+
+    def test_devices_on_different_workers(self):
+        self.assertEqual(self.presence.touch("alice", "worker1.tab1"), 1)
+        self.assertEqual(self.presence.touch("alice", "worker2.tab2"), 2)
+        # A tab closing on one worker leaves the other one counted
+        self.assertEqual(self.presence.remove("alice", "worker1.tab1"), 1)
+        self.assertEqual(self.presence.statuses(["alice", "bob"]), {"alice": ONLINE, "bob": OFFLINE})
+        self.assertEqual(self.presence.remove("alice", "worker2.tab2"), 0)
+        self.assertFalse(self.presence.is_online("alice"))
+
+    def test_connections_of_a_dead_worker_age_out(self):
+        self.redis.hset(self.presence.key("alice"), "crashed.tab", time.time() - 120)
+        self.assertFalse(self.presence.is_online("alice"))
+        self.assertEqual(self.presence.touch("alice", "worker1.tab1"), 1)
+        self.assertEqual(self.redis.hkeys(self.presence.key("alice")), [b"worker1.tab1"])
+
+    def test_announced_status_expires_without_heartbeats(self):
+        self.assertTrue(self.presence.announce("dave", ONLINE))
+        self.assertFalse(self.presence.announce("dave", ONLINE))
+        key = self.presence.announced_key("dave")
+        self.assertGreater(self.redis.ttl(key), 0)
+
+        self.redis.expire(key, 5)
+        self.presence.touch("dave", "worker1.tab1")
+        self.assertGreater(self.redis.ttl(key), 5)
+
+        # The worker died during the grace period: once the record has expired the
+        # next connection is announced again
+        self.redis.delete(key)
+        self.assertTrue(self.presence.announce("dave", ONLINE))
+
+    async def test_async_api(self):
+        self.assertEqual(await self.presence.atouch("carol", "worker1.tab1"), 1)
+        self.assertTrue(await self.presence.ais_online("carol"))
+        self.assertEqual(await self.presence.aremove("carol", "worker1.tab1"), 0)
+        self.assertEqual(await self.presence.astatuses(["carol"]), {"carol": OFFLINE})
+        self.assertTrue(await self.presence.aannounce("carol", ONLINE))
+        self.assertFalse(await self.presence.aannounce("carol", ONLINE))
+
+
+@skipIf(fakeredis is None, "fakeredis is not installed")
+@override_settings(**TEST_SETTINGS)
+class FriendsPresenceViewTests(ClearCacheMixin, FakeRedisMixin, TestCase):
+    redis_targets = ("handlers.utils.presence.get_redis",)
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user("viewer")
+        self.friend = User.objects.create_user("buddy")
+        self.stranger = User.objects.create_user("stranger")
+        FriendRequest.objects.create(from_user=self.user, to_user=self.friend, is_accepted=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_only_friends_are_reported(self):
+        response = self.client.get("/api/v1/presence/", {"users": "buddy,stranger"})
+        self.assertEqual(response.json()["data"], {"buddy": OFFLINE})
+        response = self.client.get("/api/v1/presence/")
+        self.assertEqual(response.json()["data"], {"buddy": OFFLINE})
+
+
+@skipIf(fakeredis is None, "fakeredis is not installed")
+@override_settings(**TEST_SETTINGS)
+class DeliveryGroupTests(ClearCacheMixin, FakeRedisMixin, TransactionTestCase):
+    """A connection joins a constant number of groups, however many friends the user has."""
+    redis_targets = ("handlers.utils.presence.get_async_redis",)
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user("connector")
+        friends = User.objects.bulk_create([User(username=f"contact{i}", password="!") for i in range(50)])
+        FriendRequest.objects.bulk_create([
+            FriendRequest(from_user=self.user, to_user=friend, is_accepted=True) for friend in friends
+        ])
+
+    async def group_adds_on_connect(self):
+        group_add = InMemoryChannelLayer.group_add
+        calls = []
+
+        async def counted(layer, group, channel):
+            calls.append(group)
+            return await group_add(layer, group, channel)
+
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), "/ws/chat/")
+        communicator.scope["user"] = self.user
+        with mock.patch.object(InMemoryChannelLayer, "group_add", counted):
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.receive_from()
+        await communicator.disconnect()
+        return calls
+
+    @override_settings(CHAT_ROOM_PER_PAIR=False)
+    async def test_user_group_only(self):
+        self.assertEqual(await self.group_adds_on_connect(), ["user_connector"])
+
+    @override_settings(CHAT_ROOM_PER_PAIR=True)
+    async def test_legacy_room_per_pair(self):
+        self.assertEqual(len(await self.group_adds_on_connect()), 51)
+
+
+class DatabaseExecutorTests(TransactionTestCase):
+
+    async def test_pool_threads_clean_up_connections(self):
+        with mock.patch("channels.db.close_old_connections") as close_old_connections:
+            self.assertEqual(await db_sync_to_async(User.objects.count)(), 0)
+        self.assertEqual(close_old_connections.call_count, 2)
+
+
+@override_settings(**TEST_SETTINGS)
+class UserCacheTests(TestCase):
+
+    def test_password_hash_is_not_cached(self):
+        user = User.objects.create_user("cached", password="secret-pass")
+        user_cache.invalidate(user.id)
+
+        cached_user = user_cache.get(str(user.id))
+        self.assertEqual(cached_user.username, "cached")
+        self.assertNotIn(user.password, cache.get(user_cache_key(user.id)))
+        self.assertIn("password", cached_user.get_deferred_fields())
+        # Still loaded on demand for the rare caller that needs it
+        self.assertTrue(cached_user.check_password("secret-pass"))
+
+
+class LocalHTTPServer(ThreadingHTTPServer):
+    """
+    A local HTTP stand-in: `routes` maps a path to (status, headers, body). Every
+    request is recorded in `requests`.
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.requests = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                self.requests.append(handler.path)
+                status, headers, body = self.routes.get(handler.path, (404, {}, b""))
+                handler.send_response(status)
+                for name, value in headers.items():
+                    handler.send_header(name, value)
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, *args):
+                pass
+
+        super().__init__(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.server_port}{path}"
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+CLIENT_ID = "test-client.apps.googleusercontent.com"
+
+
+@override_settings(**TEST_SETTINGS, SOCIAL_AUTH_GOOGLE_OAUTH2_KEY=CLIENT_ID)
+class GoogleTokenTests(ClearCacheMixin, TestCase):
+    """verify_google_id_token against a local fake of Google's JWKS endpoint."""
+
+    def setUp(self):
+        super().setUp()
+        self.server = LocalHTTPServer()
+        self.addCleanup(self.server.stop)
+        self.keys = {}
+        self.publish("key-1", max_age=3600)
+
+        settings_patch = override_settings(GOOGLE_CERTS_URL=self.server.url("/certs"))
+        settings_patch.enable()
+        self.addCleanup(settings_patch.disable)
+        keys_patch = mock.patch.object(google_auth, "google_keys", google_auth.GoogleKeySet())
+        keys_patch.start()
+        self.addCleanup(keys_patch.stop)
+
+    def publish(self, *kids, max_age=3600, status=200):
+        for kid in kids:
+            self.keys.setdefault(kid, rsa.generate_private_key(public_exponent=65537, key_size=2048))
+        jwks = {"keys": [
+            {**json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(self.keys[kid].public_key())), "kid": kid, "alg": "RS256", "use": "sig"}
+            for kid in kids
+        ]}
+        headers = {"Content-Type": "application/json", "Cache-Control": f"public, max-age={max_age}"}
+        self.server.routes["/certs"] = (status, headers, json.dumps(jwks).encode())
+
+    def token(self, kid="key-1", **claims):
+        now = int(time.time())
+        payload = {
+            "iss": "https://accounts.google.com", "aud": CLIENT_ID, "iat": now, "exp": now + 600,
+            "email": "someone@example.com", "email_verified": True, "given_name": "Some",
+            **claims,
+        }
+        return jwt.encode(payload, self.keys[kid], algorithm="RS256", headers={"kid": kid})
+
+    def test_valid_token(self):
+        claims = google_auth.verify_google_id_token(self.token())
+        self.assertEqual(claims["email"], "someone@example.com")
+
+    def test_rejected_tokens(self):
+        now = int(time.time())
+        for claims in (
+            {"aud": "someone-else.apps.googleusercontent.com"},
+            {"iss": "https://evil.example.com"},
+            {"iat": now - 1200, "exp": now - 600},
+            {"email_verified": False},
+        ):
+            with self.subTest(claims=claims), self.assertRaises(google_auth.InvalidGoogleToken):
+                google_auth.verify_google_id_token(self.token(**claims))
+
+        forged = jwt.encode({"aud": CLIENT_ID}, rsa.generate_private_key(public_exponent=65537, key_size=2048),
+                            algorithm="RS256", headers={"kid": "key-1"})
+        with self.assertRaises(google_auth.InvalidGoogleToken):
+            google_auth.verify_google_id_token(forged)
+
+    def test_keys_are_cached_for_max_age(self):
+        for _ in range(3):
+            google_auth.verify_google_id_token(self.token())
+        self.assertEqual(len(self.server.requests), 1)
+
+        # Another process finds them in the shared cache
+        with mock.patch.object(google_auth, "google_keys", google_auth.GoogleKeySet()):
+            google_auth.verify_google_id_token(self.token())
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_rotated_key_is_fetched_once(self):
+        google_auth.verify_google_id_token(self.token())
+        self.publish("key-1", "key-2")
+        # Unknown key ids refetch at most once per MIN_FETCH_INTERVAL
+        with self.assertRaises(google_auth.InvalidGoogleToken):
+            google_auth.verify_google_id_token(self.token(kid="key-2"))
+        self.assertEqual(len(self.server.requests), 1)
+
+        google_auth.google_keys.fetched_at -= google_auth.GoogleKeySet.MIN_FETCH_INTERVAL
+        google_auth.verify_google_id_token(self.token(kid="key-2"))
+        self.assertEqual(len(self.server.requests), 2)
+
+        self.keys["key-3"] = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        for _ in range(3):
+            with self.assertRaises(google_auth.InvalidGoogleToken):
+                google_auth.verify_google_id_token(self.token(kid="key-3"))
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_expired_keys_are_kept_when_google_is_down(self):
+        self.publish("key-1", max_age=0)
+        google_auth.verify_google_id_token(self.token())
+        self.publish("key-1", status=500)
+        google_auth.verify_google_id_token(self.token())
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_background_refresh_near_expiry(self):
+        self.publish("key-1", max_age=120)
+        google_auth.verify_google_id_token(self.token())
+        self.publish("key-1", "key-2", max_age=3600)
+        google_auth.verify_google_id_token(self.token())
+        for _ in range(100):
+            if "key-2" in google_auth.google_keys.keys:
+                break
+            time.sleep(0.02)
+        self.assertIn("key-2", google_auth.google_keys.keys)
+
+    def test_google_login_view(self):
+        User.objects.create_user("someone", email="someone@example.com")
+        client = APIClient()
+        with mock.patch("rest_framework.views.APIView.throttle_classes", []):
+            response = client.post("/api/v1/auth/google-login/", {"token": self.token()}, format="json")
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.json()["auth"])
+            response = client.post("/api/v1/auth/google-login/", {"token": self.token(aud="other")}, format="json")
+            self.assertEqual(response.status_code, 400)
+
+
+@skipIf(fakeredis is None, "fakeredis is not installed")
+@override_settings(**TEST_SETTINGS)
+class TaskWorkerTests(FakeRedisMixin, TransactionTestCase):
+    """enqueue() and TaskWorker against fakeredis, with an httpx.MockTransport for downloads."""
+    redis_targets = ("handlers.utils.tasks.get_redis", "handlers.utils.tasks.get_async_redis")
+
+    def setUp(self):
+        super().setUp()
+        autodiscover_modules("tasks")
+        self.profile = Profile.objects.create(user=User.objects.create_user("pictured"))
+        self.requests = []
+        self.response = httpx.Response(200, headers={"Content-Type": "image/jpeg"}, content=b"\xff\xd8picture")
+
+    def tearDown(self):
+        self.profile.refresh_from_db()
+        if self.profile.profile_picture:
+            self.profile.profile_picture.delete(save=False)
+
+    def handle(self, request):
+        self.requests.append(request)
+        return self.response
+
+    def run_worker(self):
+        async_to_sync(TaskWorker(burst=True, transport=httpx.MockTransport(self.handle)).run)()
+        self.profile.refresh_from_db()
+
+    def test_imports_profile_picture(self):
+        enqueue("import_profile_picture", profile_id=self.profile.id, url="https://lh3.example.com/a.jpg")
+        self.run_worker()
+        self.assertEqual([str(r.url) for r in self.requests], ["https://lh3.example.com/a.jpg"])
+        with self.profile.profile_picture.open("rb") as picture:
+            self.assertEqual(picture.read(), b"\xff\xd8picture")
+        self.assertEqual(self.redis.llen(settings.TASK_QUEUE_KEY), 0)
+
+    def test_rejects_wrong_type_and_oversize(self):
+        for response in (
+            httpx.Response(200, headers={"Content-Type": "text/html"}, content=b"<html>"),
+            httpx.Response(200, headers={"Content-Type": "image/png"}, content=b"x" * (settings.PROFILE_PICTURE_MAX_BYTES + 1)),
+        ):
+            with self.subTest(content_type=response.headers["Content-Type"]):
+                self.requests.clear()
+                self.response = response
+                enqueue("import_profile_picture", profile_id=self.profile.id, url="https://lh3.example.com/a.jpg")
+                self.run_worker()
+                self.assertEqual(len(self.requests), 1)
+                self.assertFalse(self.profile.profile_picture)
+
+    def test_failed_task_is_retried_up_to_max_attempts(self):
+        self.response = httpx.Response(503)
+        enqueue("import_profile_picture", profile_id=self.profile.id, url="https://lh3.example.com/a.jpg")
+        self.run_worker()
+        self.assertEqual(len(self.requests), settings.TASK_MAX_ATTEMPTS)
+        self.assertEqual(self.redis.llen(settings.TASK_QUEUE_KEY), 0)
+        self.assertFalse(self.profile.profile_picture)
+
+    def test_locate_profile_runs_off_the_event_loop(self):
+        def get_location(ip):
+            with self.assertRaises(RuntimeError):
+                asyncio.get_running_loop()
+            return "Paris", "France"
+
+        enqueue("locate_profile", profile_id=self.profile.id, ip="203.0.113.7")
+        with mock.patch("Chattify.tasks.get_location", side_effect=get_location) as lookup:
+            self.run_worker()
+        lookup.assert_called_once_with("203.0.113.7")
+        self.assertEqual((self.profile.city, self.profile.country), ("Paris", "France"))
@@ -14,10 +14,16 @@ urlpatterns = [
     path("set_profile/", views.set_user_profile),
     path("get_profile/", views.get_profile),
     path("chat_messages/<str:username>/", views.chat_message),
+    path("search_messages/", views.search_all_messages),
+    path("search_messages/<str:username>/", views.search_chat_messages),
+    path("export_messages/", views.export_all_messages),
+    path("export_messages/<str:username>/", views.export_chat_messages),
+    path("mark_read/<str:username>/", views.mark_messages_read),
     path("get_messages/", views.get_friends_and_messages),
     path("send_request/<str:username>/", views.send_friend_request),
     path("recieved_request/", views.pending_friend_requests),
     path("friends/", views.friends),
+    path("presence/", views.friends_presence),
     path('accept-friend-request/<str:username>/', views.accept_friend_request,),
     path('reject-friend-request/<str:username>/', views.reject_friend_request),
 ]
@@ -1,24 +1,44 @@
 from django.shortcuts import get_object_or_404
+from django.http import StreamingHttpResponse
 from rest_framework.decorators import api_view, permission_classes, authentication_classes
 from rest_framework.response import Response
 from django.contrib.auth.models import User
 from rest_framework import status
 from rest_framework.permissions import IsAuthenticated
 from django.contrib import auth
-from .serializers import UserSerializer, ProfileSerializer, ChatSerialzer, FriendRequestSerializer
+from .serializers import ProfileSerializer, serialize_chat, serialize_chat_values, serialize_user, serialize_friend_request, CHAT_VALUES
 from django.db import transaction
-from .models import Profile, Chat, FriendRequest
+from .models import Profile, Chat, FriendRequest, ConversationParticipant, Conversation
+from .search import get_search_backend
 import json
-from django.db.models import Q
+from django.db.models import Q, F, Window
+from django.db.models.functions import RowNumber, Least, Greatest
 from django.contrib.auth import authenticate
 from rest_framework_simplejwt.views import (TokenRefreshView)
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.conf import settings
 import jwt
 from datetime import datetime, timedelta, timezone
-import requests
 from handlers.utils.get_agent import get_client_ip, get_location
+from handlers.utils.google_auth import verify_google_id_token, InvalidGoogleToken
 from handlers.utils.cookies.setCookie import set_cookie
+from handlers.utils.export import ndjson_stream, json_array_stream, buffered, gzip_stream, aiter_stream
+from handlers.utils.friends_cache import get_friends, invalidate_friends
+from handlers.utils.notify import notify_user, notify_friendship_changed
+from handlers.utils.tasks import enqueue
+from handlers.utils.presence import presence
+from handlers.utils.pagination import paginate_messages, conversation_querysets, get_page_size, encode_cursor, InvalidCursor
+
+
+def _create_profile(user, request):
+    """The new user's profile, located from the registering IP now or by the task worker."""
+    client_ip = get_client_ip(request)
+    if settings.GEOIP_IN_BACKGROUND:
+        profile = Profile.objects.create(user=user, ip_address=client_ip)
+        enqueue("locate_profile", profile_id=profile.id, ip=client_ip)
+        return profile
+    city, country = get_location(client_ip)
+    return Profile.objects.create(user=user, ip_address=client_ip, city=city, country=country)
 
 
 # Create your views here.
@@ -90,16 +110,14 @@ def google_login(request):
         if not token:
             return Response({'error': 'Token is required'}, status=status.HTTP_400_BAD_REQUEST)
 
-        google_url = f"https://oauth2.googleapis.com/tokeninfo?id_token={token}"
-        response = requests.get(google_url)
-        
-        if response.status_code != 200:
+        try:
+            user_data = verify_google_id_token(token)
+        except InvalidGoogleToken:
             return Response({
                 "status":"error",
                 'message': 'Invalid token'
             }, status=status.HTTP_400_BAD_REQUEST)
         
-        user_data = response.json()
         email = user_data.get('email')
         given_name = user_data.get('given_name')
 
@@ -149,16 +167,14 @@ def google_register(request):
                 'message': 'Token is required'
             }, status=status.HTTP_400_BAD_REQUEST)
 
-        google_url = f"https://oauth2.googleapis.com/tokeninfo?id_token={token}"
-        response = requests.get(google_url)
-
-        if response.status_code != 200:
+        try:
+            user_data = verify_google_id_token(token)
+        except InvalidGoogleToken:
             return Response({
                 "status": "error",
                 'message': 'Invalid token'
             }, status=status.HTTP_400_BAD_REQUEST)
         
-        user_data = response.json()
         email = user_data.get('email')
         picture = user_data.get('picture')
         given_name = user_data.get('given_name')
@@ -192,20 +208,11 @@ def google_register(request):
             password=None
         )
 
-        client_ip = get_client_ip(request)
-        city, country = get_location(client_ip)
-        profile = Profile.objects.create(user=user, ip_address=client_ip, city=city, country=country)
+        profile = _create_profile(user, request)
         
+        # The avatar is copied by the task worker, not while the user waits
         if picture:
-            try:
-                img_response = requests.get(picture)
-                if img_response.status_code == 200:
-                    from django.core.files.base import ContentFile
-                    img_filename = f"profile_image{user.id}ddwm.jpg"
-                    
-                    profile.profile_picture.save(img_filename, ContentFile(img_response.content), save=True)
-            except Exception as e:
-                print(f"Error downloading profile picture: {e}")
+            enqueue("import_profile_picture", profile_id=profile.id, url=picture)
         
         user.save()
 
@@ -252,10 +259,7 @@ def register(request):
                 user = User.objects.create_user(username=username, email=email, password=password)
                 user.save()
 
-                client_ip = get_client_ip(request)
-                city, country = get_location(client_ip)
-
-                Profile.objects.create(user=user, ip_address=client_ip, city=city, country=country)
+                _create_profile(user, request)
                 
                 response =  Response({
                     "status":"success",
@@ -319,13 +323,12 @@ def get_users(request):
     user = request.user
 
     try:
-        all_users = User.objects.all().exclude(id=user.id)
+        all_users = User.objects.all().exclude(id=user.id).select_related('profile')
         
-        serializer = UserSerializer(all_users, many=True)
         return Response({
             "status":"success",
             "data":{
-                "users":serializer.data,
+                "users":[serialize_user(other) for other in all_users],
             }
         }, status=status.HTTP_200_OK)
     
@@ -440,18 +443,29 @@ def chat_message(request, username):
             
     try:
 
-        all_messages = Chat.objects.filter(
-            (Q(user=user) & Q(recipient=friend_user)) |
-            (Q(user=friend_user) & Q(recipient=user))
-        ).order_by('-sent_at')
+        all_messages = conversation_querysets(
+            Chat.objects.select_related('user', 'recipient'), user, friend_user
+        )
 
-        serializer = ChatSerialzer(all_messages, many=True)
-        serialize_profile = UserSerializer(friend_user)
+        try:
+            page = paginate_messages(
+                all_messages,
+                before=request.query_params.get("before"),
+                after=request.query_params.get("after"),
+                limit=get_page_size(request.query_params.get("limit")),
+            )
+        except InvalidCursor as e:
+            return Response({
+                "status":"error",
+                "message":str(e)
+            }, status=status.HTTP_400_BAD_REQUEST)
 
         return Response({
             "data":{
-                "messages":serializer.data,
-                "friend":serialize_profile.data
+                "messages":[serialize_chat(message) for message in page["items"]],
+                "friend":serialize_user(friend_user),
+                "cursors":page["cursors"],
+                "has_more":page["has_more"],
             }
         },status=status.HTTP_200_OK)
         
@@ -463,6 +477,157 @@ def chat_message(request, username):
         }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+def _export_response(request, messages, filename):
+    """Stream `messages` as NDJSON (default) or a JSON array, optionally gzipped."""
+    # Not `format`: DRF reserves that query parameter for renderer selection.
+    export_format = request.query_params.get("mode", "ndjson")
+    if export_format not in ("ndjson", "json"):
+        return Response({
+            "status":"error",
+            "message":"mode must be 'ndjson' or 'json'"
+        }, status=status.HTTP_400_BAD_REQUEST)
+
+    rows = (
+        serialize_chat_values(row)
+        for row in messages.order_by('sent_at', 'id').values(*CHAT_VALUES).iterator(
+            chunk_size=settings.CHAT_EXPORT_CHUNK_SIZE
+        )
+    )
+    stream = ndjson_stream(rows) if export_format == "ndjson" else json_array_stream(rows)
+    stream = buffered(stream)
+    content_type = "application/x-ndjson" if export_format == "ndjson" else "application/json"
+    filename = f"{filename}.{export_format}"
+
+    if request.query_params.get("compress") == "gzip":
+        stream = gzip_stream(stream)
+        content_type = "application/gzip"
+        filename = f"{filename}.gz"
+
+    response = StreamingHttpResponse(aiter_stream(stream), content_type=content_type)
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def export_chat_messages(request, username):
+    user = request.user
+    friend_user = get_object_or_404(User, username=username)
+
+    messages = Chat.objects.filter(
+        (Q(user=user) & Q(recipient=friend_user)) |
+        (Q(user=friend_user) & Q(recipient=user))
+    )
+    return _export_response(request, messages, f"chattify-{user.username}-{friend_user.username}")
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def export_all_messages(request):
+    user = request.user
+
+    messages = Chat.objects.filter(Q(user=user) | Q(recipient=user))
+    return _export_response(request, messages, f"chattify-{user.username}")
+
+
+def _search_response(request, friend_user=None):
+    query = request.query_params.get("q", "")
+    if not query.strip():
+        return Response({
+            "status":"error",
+            "message":"q is required"
+        }, status=status.HTTP_400_BAD_REQUEST)
+
+    limit = get_page_size(
+        request.query_params.get("limit"),
+        default=settings.CHAT_SEARCH_PAGE_SIZE,
+        maximum=settings.CHAT_SEARCH_MAX_PAGE_SIZE,
+    )
+    try:
+        offset = max(0, int(request.query_params.get("offset", 0)))
+    except ValueError:
+        offset = 0
+
+    try:
+        hits, has_more = get_search_backend().search(
+            request.user, query, friend=friend_user, limit=limit, offset=offset
+        )
+
+        return Response({
+            "status":"success",
+            "data":{
+                "results":hits,
+                "next_offset":offset + limit if has_more else None,
+            }
+        }, status=status.HTTP_200_OK)
+
+    except Exception as e:
+        return Response({
+            "status":"error",
+            "message":f"Error searching messages {e}"
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def search_all_messages(request):
+    return _search_response(request)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def search_chat_messages(request, username):
+    friend_user = get_object_or_404(User, username=username)
+    return _search_response(request, friend_user)
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def mark_messages_read(request, username):
+    user = request.user
+    friend_user = get_object_or_404(User, username=username)
+    message_id = request.data.get("message_id")
+
+    if not message_id:
+        return Response({
+            "status":"error",
+            "message":"message_id is required"
+        }, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        result = Conversation.mark_read(user, friend_user, message_id)
+
+        if result is None:
+            return Response({
+                "status":"error",
+                "message":"message not available"
+            }, status=status.HTTP_404_NOT_FOUND)
+
+        message, updated, read_at = result
+
+        if updated:
+            notify_user(friend_user.username, {
+                'type': 'read_receipt',
+                'reader': user.username,
+                'message_id': message.id,
+                'read_at': read_at.isoformat(),
+            })
+
+        return Response({
+            "status":"success",
+            "data":{
+                "updated":updated,
+                "read_at":read_at,
+            }
+        }, status=status.HTTP_200_OK)
+
+    except Exception as e:
+        return Response({
+            "status":"error",
+            "message":f"Error marking messages as read {e}"
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def delete_chat_message(request, message_id):
@@ -497,29 +662,62 @@ def delete_chat_message(request, message_id):
 def get_friends_and_messages(request):
     try:
         user = request.user
-        friends = FriendRequest.objects.filter(
-            Q(from_user=user, is_accepted=True) | Q(to_user=user, is_accepted=True)
-        ).select_related('from_user', 'to_user')
+        per_friend = get_page_size(
+            request.query_params.get("limit"),
+            default=settings.INBOX_MESSAGES_PER_FRIEND,
+            maximum=settings.INBOX_MAX_MESSAGES_PER_FRIEND,
+        )
+
+        friend_ids = {
+            from_user_id if to_user_id == user.id else to_user_id
+            for from_user_id, to_user_id in FriendRequest.objects.filter(
+                Q(from_user=user, is_accepted=True) | Q(to_user=user, is_accepted=True)
+            ).values_list('from_user_id', 'to_user_id')
+        }
+        friend_ids.discard(user.id)
+
+        memberships = {
+            (membership.conversation.user_two_id
+             if membership.conversation.user_one_id == user.id
+             else membership.conversation.user_one_id): membership
+            for membership in ConversationParticipant.objects.filter(user=user).select_related('conversation')
+        }
+
+        # Last `per_friend` messages of every conversation in a single query: number the
+        # rows of each pair newest first and keep the top of each partition.
+        recent_messages = Chat.objects.filter(
+            Q(user=user, recipient_id__in=friend_ids) | Q(user_id__in=friend_ids, recipient=user)
+        ).annotate(
+            position=Window(
+                RowNumber(),
+                partition_by=[Least('user_id', 'recipient_id'), Greatest('user_id', 'recipient_id')],
+                order_by=[F('sent_at').desc(), F('id').desc()],
+            )
+        ).filter(position__lte=per_friend).select_related('user', 'recipient').order_by('sent_at', 'id')
+
+        messages_by_friend = {}
+        for message in recent_messages:
+            friend_id = message.recipient_id if message.user_id == user.id else message.user_id
+            messages_by_friend.setdefault(friend_id, []).append(message)
 
         friend_data = []
-        seen_chat_pairs = set() 
 
-        for friend in friends:
-            friend_user = friend.to_user if friend.from_user == user else friend.from_user
-            chat_pair = tuple(sorted([user.id, friend_user.id]))
-            
-            if chat_pair not in seen_chat_pairs:
-                seen_chat_pairs.add(chat_pair)
+        for friend_user in User.objects.filter(id__in=friend_ids).select_related('profile'):
+            membership = memberships.get(friend_user.id)
+            messages = messages_by_friend.get(friend_user.id, [])
+            oldest = messages[0] if messages else None
 
-                messages = Chat.objects.filter(
-                    (Q(user=user) & Q(recipient=friend_user)) |
-                    (Q(user=friend_user) & Q(recipient=user))
-                ).order_by('sent_at').distinct()
+            friend_data.append({
+                "friend": serialize_user(friend_user),
+                "messages": [serialize_chat(message) for message in messages],
+                "unread_count": membership.unread_count if membership else 0,
+                "last_activity": membership.conversation.last_activity if membership else None,
+                # Older history is fetched from chat_messages/<username>/?before=<cursor>
+                "before": encode_cursor(oldest.sent_at, oldest.id) if len(messages) == per_friend else None,
+            })
 
-                friend_data.append({
-                    "friend": UserSerializer(friend_user).data,
-                    "messages": ChatSerialzer(messages, many=True).data
-                })
+        # Most recently active conversations first, friends we never talked to last.
+        friend_data.sort(key=lambda item: item["last_activity"] or datetime.min.replace(tzinfo=timezone.utc), reverse=True)
 
         return Response({"chats": friend_data}, status=status.HTTP_200_OK)
 
@@ -549,7 +747,7 @@ def send_friend_request(request, username):
                 "message":"Friend request already sent."
             }, status=status.HTTP_400_BAD_REQUEST)
 
-        elif FriendRequest.objects.filter(from_user=request.user, to_user=to_user, is_accepted=True).exists():
+        elif to_user.id in get_friends(request.user.id):
             return Response({
                 "status":"error",
                 "message":f"You're already friends with {to_user.username}"
@@ -581,14 +779,18 @@ def send_friend_request(request, username):
 def pending_friend_requests(request):
     try:
         user = request.user
-        received = FriendRequest.objects.filter(to_user=user, is_accepted=False)
-        received_serialized = FriendRequestSerializer(received, many=True).data
+        received = FriendRequest.objects.filter(
+            to_user=user, is_accepted=False
+        ).select_related('from_user__profile', 'to_user__profile')
+        received_serialized = [serialize_friend_request(item) for item in received]
         for item in received_serialized:
             item["request_type"] = "received"
             item["status"] = "accept" 
 
-        sent = FriendRequest.objects.filter(from_user=user, is_accepted=False)
-        sent_serialized = FriendRequestSerializer(sent, many=True).data
+        sent = FriendRequest.objects.filter(
+            from_user=user, is_accepted=False
+        ).select_related('from_user__profile', 'to_user__profile')
+        sent_serialized = [serialize_friend_request(item) for item in sent]
         for item in sent_serialized:
             item["request_type"] = "sent"
             item["status"] = "pending" 
@@ -607,15 +809,41 @@ def pending_friend_requests(request):
         }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def friends_presence(request):
+    try:
+        friends = set(get_friends(request.user.id).values())
+        requested = request.query_params.get("users")
+        if requested:
+            # Only friends' presence is visible; other usernames are left out
+            usernames = [username for username in requested.split(",") if username in friends]
+            usernames = usernames[:settings.PRESENCE_MAX_LOOKUP]
+        else:
+            usernames = list(friends)
+
+        return Response({
+            "status":"success",
+            "data": presence.statuses(usernames)
+        }, status=status.HTTP_200_OK)
+
+    except Exception as e:
+        return Response({
+            "status":"error",
+            "message":f"error fetching presence {e}"
+        } ,status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def friends(request):
     try:
-        accepted_requests = FriendRequest.objects.filter(is_accepted=True, to_user=request.user)
-        serializer = FriendRequestSerializer(accepted_requests, many=True)
+        accepted_requests = FriendRequest.objects.filter(
+            is_accepted=True, to_user=request.user
+        ).select_related('from_user__profile', 'to_user__profile')
         return Response({
             "status":"success",
-            "data": serializer.data
+            "data": [serialize_friend_request(item) for item in accepted_requests]
         }, status=status.HTTP_200_OK)
     
     except Exception as e:
@@ -630,11 +858,12 @@ def friends(request):
 @permission_classes([IsAuthenticated])
 def sent_request(request):
     try:
-        sent_requests = FriendRequest.objects.filter(from_user=request.user)
-        serializer = FriendRequestSerializer(sent_requests, many=True)
+        sent_requests = FriendRequest.objects.filter(
+            from_user=request.user
+        ).select_related('from_user__profile', 'to_user__profile')
         return Response({
             "status":"sucess",
-            "data": serializer.data
+            "data": [serialize_friend_request(item) for item in sent_requests]
         }, status=status.HTTP_200_OK)
     
     except Exception as e:
@@ -663,6 +892,9 @@ def accept_friend_request(request, username):
             friend_request = FriendRequest.objects.get(from_user=from_user, to_user=request.user)
             friend_request.is_accepted = True
             friend_request.save()
+            Conversation.get_for_pair(from_user.id, request.user.id)
+            invalidate_friends(from_user.id, request.user.id)
+            notify_friendship_changed(request.user, from_user, "accepted")
         except FriendRequest.DoesNotExist:
             return Response({
                 "status":"error",
@@ -697,8 +929,12 @@ def reject_friend_request(request, username):
 
         try:
             friend_request = FriendRequest.objects.get(from_user=from_user, to_user=request.user)
+            was_friend = friend_request.is_accepted
             friend_request.is_accepted = False
             friend_request.delete()
+            invalidate_friends(from_user.id, request.user.id)
+            if was_friend:
+                notify_friendship_changed(request.user, from_user, "removed")
         except FriendRequest.DoesNotExist:
             return Response({
                 "status":"error",
@@ -0,0 +1,213 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from datetime import datetime
+
+from django.conf import settings
+from django.db import transaction, InterfaceError, OperationalError
+
+from handlers.utils.db_executor import db_sync_to_async
+from handlers.utils.redis_client import get_async_redis
+from .models import Chat, Conversation
+
+logger = logging.getLogger(__name__)
+
+
+def journal_record(chat):
+    return json.dumps({
+        'message_id': str(chat.message_id),
+        'user_id': chat.user_id,
+        'recipient_id': chat.recipient_id,
+        'message': chat.message,
+        'sent_at': chat.sent_at.isoformat(),
+    })
+
+
+def chat_from_record(record):
+    data = json.loads(record)
+    return Chat(
+        message_id=uuid.UUID(data['message_id']),
+        user_id=data['user_id'],
+        recipient_id=data['recipient_id'],
+        message=data['message'],
+        sent_at=datetime.fromisoformat(data['sent_at']),
+    )
+
+
+def persist_messages(chats):
+    """
+    Insert a batch of messages and update their conversations in one transaction.
+    Messages whose UUID is already stored (journal replays) are skipped.
+    """
+    existing = set(
+        Chat.objects.filter(message_id__in=[chat.message_id for chat in chats])
+        .values_list('message_id', flat=True)
+    )
+    new_chats = [chat for chat in chats if chat.message_id not in existing]
+    if not new_chats:
+        return []
+
+    with transaction.atomic():
+        created = Chat.objects.bulk_create(new_chats)
+        Conversation.record_messages(created)
+    return created
+
+
+def persist_batch(batch):
+    """
+    Persist `batch` of (chat, record) pairs. If the batch as a whole fails, fall back
+    to one message at a time so a single bad row cannot hold back the rest.
+
+    Returns (persisted, dead, retry): `dead` pairs a record with the error that makes
+    it impossible to store (a constraint or foreign key violation, say); `retry` holds
+    the messages left untried because the database itself is unavailable.
+    """
+    try:
+        persist_messages([chat for chat, _ in batch])
+        return batch, [], []
+    except Exception as e:
+        logger.warning(f"Write-behind batch of {len(batch)} messages failed, inserting one at a time: {e}")
+
+    persisted, dead = [], []
+    for position, (chat, record) in enumerate(batch):
+        # The failed bulk insert may have assigned ids before rolling back
+        chat.pk = None
+        try:
+            persist_messages([chat])
+        except (OperationalError, InterfaceError) as e:
+            logger.error(f"Write-behind flush stopped, database unavailable: {e}")
+            return persisted, dead, batch[position:]
+        except Exception as e:
+            dead.append((record, str(e)))
+            continue
+        persisted.append((chat, record))
+    return persisted, dead, []
+
+
+class MessageWriteBehind:
+    """
+    Per-worker write-behind buffer for chat messages.
+
+    `submit` journals the message in this worker's own Redis list and returns, so the
+    caller can broadcast right away. Buffered messages are written with bulk_create
+    once CHAT_WRITE_BEHIND_BATCH_SIZE are pending or CHAT_WRITE_BEHIND_FLUSH_INTERVAL
+    has passed, and only then removed from the journal. Messages that cannot be
+    stored at all are moved to CHAT_WRITE_BEHIND_DEAD_LETTER_KEY.
+
+    Every worker records a heartbeat in a sorted set. The journal of a worker whose
+    heartbeat is older than CHAT_WRITE_BEHIND_WORKER_TIMEOUT is claimed by one live
+    worker, moved into its own journal and flushed like its own messages.
+    """
+
+    def __init__(self):
+        self.buffer = []
+        self.flush_task = None
+        self.heartbeat_task = None
+        self.lock = None
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    @staticmethod
+    def journal_key(worker_id):
+        return f"{settings.CHAT_WRITE_BEHIND_JOURNAL_KEY}:{worker_id}"
+
+    @staticmethod
+    def workers_key():
+        return f"{settings.CHAT_WRITE_BEHIND_JOURNAL_KEY}:workers"
+
+    async def submit(self, chat):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        if self.heartbeat_task is None:
+            await self.beat()
+            self.heartbeat_task = asyncio.create_task(self.heartbeat())
+
+        record = journal_record(chat)
+        await get_async_redis().rpush(self.journal_key(self.worker_id), record)
+        self.buffer.append((chat, record))
+
+        if len(self.buffer) >= settings.CHAT_WRITE_BEHIND_BATCH_SIZE:
+            await self.flush()
+        else:
+            self.schedule_flush()
+
+    def schedule_flush(self):
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(settings.CHAT_WRITE_BEHIND_FLUSH_INTERVAL)
+        self.flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        async with self.lock:
+            batch, self.buffer = self.buffer, []
+            if not batch:
+                return
+
+            persisted, dead, retry = await db_sync_to_async(persist_batch)(batch)
+            if retry:
+                # Still journaled; try again on the next tick.
+                self.buffer = retry + self.buffer
+                self.schedule_flush()
+
+            redis = get_async_redis()
+            journal = self.journal_key(self.worker_id)
+            pipe = redis.pipeline(transaction=False)
+            for record, error in dead:
+                logger.error(f"Moving unstorable message to the dead-letter list: {error}")
+                pipe.rpush(settings.CHAT_WRITE_BEHIND_DEAD_LETTER_KEY, json.dumps({**json.loads(record), 'error': error}))
+            for record in [record for _, record in persisted] + [record for record, _ in dead]:
+                pipe.lrem(journal, 1, record)
+            await pipe.execute()
+
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(settings.CHAT_WRITE_BEHIND_WORKER_TIMEOUT / 3)
+            try:
+                await self.beat()
+            except Exception as e:
+                logger.error(f"Write-behind heartbeat failed: {e}")
+
+    async def beat(self):
+        """Refresh this worker's heartbeat and take over the journals of dead workers."""
+        redis = get_async_redis()
+        now = time.time()
+        await redis.zadd(self.workers_key(), {self.worker_id: now})
+
+        dead_workers = await redis.zrangebyscore(
+            self.workers_key(), 0, now - settings.CHAT_WRITE_BEHIND_WORKER_TIMEOUT
+        )
+        for worker_id in dead_workers:
+            worker_id = worker_id.decode()
+            # ZREM succeeds for exactly one live worker, which then owns the journal
+            if worker_id == self.worker_id or not await redis.zrem(self.workers_key(), worker_id):
+                continue
+            try:
+                await self.adopt(worker_id)
+            except Exception as e:
+                logger.error(f"Recovering the journal of {worker_id} failed, will retry: {e}")
+                await redis.zadd(self.workers_key(), {worker_id: 0})
+
+    async def adopt(self, worker_id):
+        """Move a dead worker's journal into ours and flush it with our own messages."""
+        redis = get_async_redis()
+        dead_journal = self.journal_key(worker_id)
+        records = await redis.lrange(dead_journal, 0, -1)
+        if records:
+            pipe = redis.pipeline(transaction=True)
+            pipe.rpush(self.journal_key(self.worker_id), *records)
+            pipe.delete(dead_journal)
+            await pipe.execute()
+            self.buffer.extend((chat_from_record(record), record) for record in records)
+            self.schedule_flush()
+            logger.info(f"Recovering {len(records)} journaled messages from {worker_id}")
+        else:
+            await redis.delete(dead_journal)
+
+
+write_behind = MessageWriteBehind()
@@ -66,6 +66,11 @@ AUTHENTICATION_BACKENDS = (
 SOCIAL_AUTH_GOOGLE_OAUTH2_KEY = os.getenv("SOCIAL_AUTH_GOOGLE_OAUTH2_KEY")
 SOCIAL_AUTH_GOOGLE_OAUTH2_SECRET = os.getenv("SOCIAL_AUTH_GOOGLE_OAUTH2_SECRET")
 
+# Google ID tokens are verified locally against these keys (handlers.utils.google_auth)
+GOOGLE_CERTS_URL = os.getenv("GOOGLE_CERTS_URL", "https://www.googleapis.com/oauth2/v3/certs")
+GOOGLE_JWKS_TIMEOUT = 5  # seconds
+GOOGLE_JWKS_REFRESH_MARGIN = 60 * 5  # refresh in the background this long before expiry
+
 
 
 from datetime import timedelta
@@ -99,6 +104,10 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
     ),
+    'DEFAULT_RENDERER_CLASSES': (
+        'handlers.utils.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
     'DEFAULT_THROTTLE_CLASSES': [
         'rest_framework.throttling.UserRateThrottle',
         'rest_framework.throttling.AnonRateThrottle',
@@ -138,13 +147,100 @@ CORS_ALLOW_METHODS = (
     "PUT",
 )
 
+REDIS_URL = 'redis://127.0.0.1:6379/1'
+
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.redis.RedisCache',
-        'LOCATION': 'redis://127.0.0.1:6379/1',
+        'LOCATION': REDIS_URL,
     }
 }
 
+# Chat history pagination (cursor based, see handlers.utils.pagination)
+CHAT_MESSAGES_PAGE_SIZE = 50
+CHAT_MESSAGES_MAX_PAGE_SIZE = 200
+
+# Message search. SQLiteFTSBackend needs the FTS5 table from migration 0020;
+# Chattify.search.DatabaseSearchBackend works on any database without an index.
+CHAT_SEARCH_BACKEND = 'Chattify.search.SQLiteFTSBackend'
+CHAT_SEARCH_PAGE_SIZE = 20
+CHAT_SEARCH_MAX_PAGE_SIZE = 100
+
+# Rows fetched per database round trip by the streaming export endpoints
+CHAT_EXPORT_CHUNK_SIZE = 2000
+
+# Inbox (get_messages/): how many recent messages are returned per friend
+INBOX_MESSAGES_PER_FRIEND = 20
+INBOX_MAX_MESSAGES_PER_FRIEND = 100
+
+# Authenticated user cache (handlers.utils.user_cache): a per-process LRU in front of
+# the shared cache, invalidated when a user is saved or deleted
+USER_CACHE_TIMEOUT = 60 * 5
+USER_CACHE_LOCAL_TTL = 5
+USER_CACHE_LOCAL_SIZE = 1024
+
+# Friend adjacency cache (handlers.utils.friends_cache), invalidated on friendship changes
+FRIENDS_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Messages and typing events go to each user's personal `user_<username>` group.
+# True restores the old model of one channel group per friend pair, joined on connect.
+CHAT_ROOM_PER_PAIR = False
+
+# Missed-message catch-up on reconnect: batch size and cap per conversation
+CHAT_SYNC_BATCH_SIZE = 100
+CHAT_SYNC_MAX_MESSAGES = 1000
+
+# How long client supplied message UUIDs are remembered to drop retried sends
+CHAT_MESSAGE_DEDUPE_TTL = 60 * 10
+
+# Threads (and so database connections) per worker for ORM calls made by consumers
+CHAT_DB_EXECUTOR_WORKERS = 8
+
+# Presence (handlers.utils.presence): every connection heartbeats its entry, and
+# entries older than PRESENCE_TTL seconds no longer count as online
+PRESENCE_TTL = 90
+PRESENCE_HEARTBEAT_INTERVAL = 30
+PRESENCE_MAX_LOOKUP = 500
+# Offline is announced only after this many seconds without a connection, and
+# presence changes are sent to each friend at most once per broadcast interval
+PRESENCE_OFFLINE_GRACE = 10
+PRESENCE_BROADCAST_INTERVAL = 1.0
+
+# Typing indicators stop on their own after this many seconds without a typing frame
+TYPING_TIMEOUT = 5
+TYPING_MAX_CONVERSATIONS = 10
+
+# Delivered receipts are coalesced per connection and flushed in batches
+DELIVERY_RECEIPT_BATCH_SIZE = 50
+DELIVERY_RECEIPT_FLUSH_INTERVAL = 1.0  # seconds
+# With write-behind, a delivered message may not be stored yet; its delivered_at is
+# retried once per flush interval, long enough to cover a dead worker's journal replay.
+DELIVERY_RECEIPT_MAX_ATTEMPTS = 60
+
+# Write-behind message persistence (Chattify.write_behind). Messages are journaled in
+# Redis (one list per worker), broadcast immediately and written with bulk_create per
+# batch. A worker silent for CHAT_WRITE_BEHIND_WORKER_TIMEOUT seconds is presumed dead
+# and its journal is replayed by another one.
+CHAT_WRITE_BEHIND = False
+CHAT_WRITE_BEHIND_BATCH_SIZE = 100
+CHAT_WRITE_BEHIND_FLUSH_INTERVAL = 0.05  # seconds
+CHAT_WRITE_BEHIND_JOURNAL_KEY = 'chattify:write_behind'
+CHAT_WRITE_BEHIND_DEAD_LETTER_KEY = 'chattify:write_behind:dead'
+CHAT_WRITE_BEHIND_WORKER_TIMEOUT = 30  # seconds
+
+# Background tasks (handlers.utils.tasks), run with `python manage.py run_tasks`
+TASK_QUEUE_KEY = 'chattify:tasks'
+TASK_WORKER_CONCURRENCY = 10
+TASK_MAX_ATTEMPTS = 3
+TASK_HTTP_TIMEOUT = 10  # seconds
+PROFILE_PICTURE_MAX_BYTES = 5 * 1024 * 1024
+
+# GeoIP: repeated registration IPs are answered from a per-process LRU of this many
+# entries. With GEOIP_IN_BACKGROUND the lookup runs in the task worker and the new
+# profile's city/country are filled in shortly after registration.
+GEOIP_CACHE_SIZE = 4096
+GEOIP_IN_BACKGROUND = False
+
 # SESSION_COOKIE_AGE = 60 * 60 * 24 * 7 
 # SESSION_COOKIE_SECURE = False 
 # CSRF_COOKIE_SECURE = False 
@@ -1,21 +1,29 @@
 
-from django.contrib.auth import get_user_model
 from rest_framework_simplejwt.tokens import AccessToken
 from django.contrib.auth.models import AnonymousUser
+from .user_cache import user_cache
 import logging
 
 logger = logging.getLogger(__name__)
-User = get_user_model()
 
 def get_user_from_token(token):
     """
-    Decode a JWT token and return a User instance.
-    Returns AnonymousUser if token is invalid.
+    Decode a JWT token and return a User instance, from the user cache when warm.
+    Returns AnonymousUser if token is invalid or the user is missing or inactive.
     """
     try:
-        access_token = AccessToken(token)
-        user = User.objects.get(id=access_token['user_id'])
-        return user
+        return get_user_from_access_token(AccessToken(token))
     except Exception as e:
         logger.warning(f"Token validation failed: {e}")
         return AnonymousUser()
+
+
+def get_user_from_access_token(access_token):
+    """
+    Return the User for an already validated AccessToken.
+    Returns AnonymousUser if the user is missing or inactive.
+    """
+    user = user_cache.get(access_token['user_id'])
+    if user is None or not user.is_active:
+        return AnonymousUser()
+    return user
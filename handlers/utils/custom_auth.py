@@ -1,5 +1,5 @@
 from rest_framework_simplejwt.authentication import JWTAuthentication
-from .auth_helpers import get_user_from_token
+from .auth_helpers import get_user_from_token, get_user_from_access_token
 
 class CookieJWTAuthentication(JWTAuthentication):
     """
@@ -22,6 +22,14 @@ class CookieJWTAuthentication(JWTAuthentication):
         return parts[1]
 
     def authenticate(self, request):
+        # SilentRefreshJwtMiddleware already validated the cookie, or refreshed it
+        access_token = getattr(request, "jwt_access_token", None)
+        if access_token is not None:
+            user = get_user_from_access_token(access_token)
+            if user.is_anonymous:
+                return None
+            return (user, access_token)
+
         raw_token = self.get_raw_token(request)
         if not raw_token:
             return None
@@ -0,0 +1,36 @@
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+
+_executor = None
+
+
+def get_db_executor():
+    """
+    Process-wide pool for ORM calls made from async code. Each thread keeps its own
+    database connection, so CHAT_DB_EXECUTOR_WORKERS also caps the connections a worker opens.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.CHAT_DB_EXECUTOR_WORKERS,
+            thread_name_prefix="chattify-db",
+        )
+    return _executor
+
+
+def db_sync_to_async(func):
+    """
+    database_sync_to_async on the bounded DB pool instead of the single thread-sensitive
+    thread, so one connection's query does not hold up every other connection on the
+    worker. Like Channels' version it calls close_old_connections() around `func`, so
+    pool threads drop broken or expired connections. `func` must not depend on
+    thread-local state from the calling context.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await DatabaseSyncToAsync(func, thread_sensitive=False, executor=get_db_executor())(*args, **kwargs)
+
+    return wrapper
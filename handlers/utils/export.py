@@ -0,0 +1,63 @@
+import zlib
+
+from asgiref.sync import sync_to_async
+
+from .renderers import dumps
+
+CHUNK_BYTES = 64 * 1024
+
+
+def ndjson_stream(rows):
+    """One JSON document per line."""
+    for row in rows:
+        yield dumps(row) + b"\n"
+
+
+def json_array_stream(rows):
+    """A single JSON array, written element by element."""
+    yield b"["
+    separator = b""
+    for row in rows:
+        yield separator + dumps(row)
+        separator = b","
+    yield b"]"
+
+
+def buffered(chunks, size=CHUNK_BYTES):
+    """Join small pieces so the server writes reasonably sized chunks."""
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        if len(buffer) >= size:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+def gzip_stream(chunks):
+    """Compress a byte stream on the fly into a single gzip member."""
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+async def aiter_stream(chunks):
+    """
+    Serve a blocking byte stream from an async generator, one chunk per thread hop.
+
+    Given a sync iterator, StreamingHttpResponse under ASGI drains it with
+    sync_to_async(list) before sending anything. Pulling each chunk separately keeps
+    only one chunk in memory. The pulls stay on the same thread (thread_sensitive),
+    which owns the database cursor of the underlying queryset iterator.
+    """
+    chunks = iter(chunks)
+    pull = sync_to_async(next, thread_sensitive=True)
+    while True:
+        chunk = await pull(chunks, None)
+        if chunk is None:
+            return
+        yield chunk
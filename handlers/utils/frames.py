@@ -0,0 +1,64 @@
+import json
+
+from rest_framework.utils.encoders import JSONEncoder
+
+from .renderers import dumps
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - only JSON frames are offered then
+    msgpack = None
+
+MSGPACK_SUBPROTOCOL = "chattify.msgpack"
+
+
+class JSONFrames:
+    """The default WebSocket encoding: one JSON document per text frame."""
+
+    subprotocol = None
+
+    def encode(self, payload):
+        """Keyword arguments for AsyncWebsocketConsumer.send()."""
+        return {"text_data": dumps(payload).decode()}
+
+    def encode_with(self, body, extra):
+        """
+        Like encode(), for a payload that was already encoded as the JSON object `body`
+        plus a few per-connection fields, which are appended without re-encoding the rest.
+        """
+        return {"text_data": body[:-1] + "," + dumps(extra).decode()[1:]}
+
+    def decode(self, text_data=None, bytes_data=None):
+        return json.loads(text_data if text_data is not None else bytes_data)
+
+
+class MsgPackFrames(JSONFrames):
+    """
+    MessagePack in binary frames, for clients that ask for the `chattify.msgpack`
+    subprotocol. Payloads have the same shape as the JSON ones; datetimes and UUIDs
+    are sent as strings, and media can be sent as raw bytes instead of base64.
+    Text frames are still read as JSON.
+    """
+
+    subprotocol = MSGPACK_SUBPROTOCOL
+
+    def __init__(self):
+        self.encoder = JSONEncoder()
+
+    def encode(self, payload):
+        return {"bytes_data": msgpack.packb(payload, default=self.encoder.default)}
+
+    def encode_with(self, body, extra):
+        return self.encode({**json.loads(body), **extra})
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            return super().decode(text_data)
+        return msgpack.unpackb(bytes_data)
+
+
+def negotiate(subprotocols):
+    """Pick the frame encoding from the subprotocols offered in the handshake."""
+    if msgpack is not None and MSGPACK_SUBPROTOCOL in (subprotocols or ()):
+        return MsgPackFrames()
+    return JSONFrames()
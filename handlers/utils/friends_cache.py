@@ -0,0 +1,86 @@
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+
+from .db_executor import db_sync_to_async
+
+
+def friends_version_key(user_id):
+    return f"friends_version_{user_id}"
+
+
+def friends_cache_key(user_id, version):
+    return f"friends_{user_id}_{version}"
+
+
+def _new_version():
+    # Random rather than a counter, so a version key that was evicted can never
+    # come back as a value some stale list was cached under.
+    return uuid.uuid4().hex
+
+
+def load_friends(user_id):
+    """Read a user's accepted friendships from the database as {friend_id: username}."""
+    from Chattify.models import FriendRequest
+
+    rows = FriendRequest.objects.filter(
+        Q(is_accepted=True) & (Q(from_user_id=user_id) | Q(to_user_id=user_id))
+    ).values_list('from_user_id', 'from_user__username', 'to_user_id', 'to_user__username')
+
+    friends = {}
+    for from_id, from_username, to_id, to_username in rows:
+        if from_id == user_id:
+            friends[to_id] = to_username
+        else:
+            friends[from_id] = from_username
+    friends.pop(user_id, None)
+    return friends
+
+
+def get_friends(user_id):
+    """
+    Friend adjacency for a user as {friend_id: username}.
+    Populated lazily from the database and kept in the shared cache until a
+    friendship involving the user changes. The list is stored under the user's
+    current version, which invalidate_friends() replaces; a reader that loaded
+    the list before a change writes it under the old version, where nobody
+    looks for it anymore.
+    """
+    version_key = friends_version_key(user_id)
+    version = cache.get(version_key)
+    if version is None:
+        cache.add(version_key, _new_version(), timeout=None)
+        version = cache.get(version_key)
+
+    key = friends_cache_key(user_id, version)
+    friends = cache.get(key)
+    if friends is None:
+        friends = load_friends(user_id)
+        cache.set(key, friends, timeout=settings.FRIENDS_CACHE_TIMEOUT)
+    return friends
+
+
+async def aget_friends(user_id):
+    version_key = friends_version_key(user_id)
+    version = await cache.aget(version_key)
+    if version is None:
+        await cache.aadd(version_key, _new_version(), timeout=None)
+        version = await cache.aget(version_key)
+
+    key = friends_cache_key(user_id, version)
+    friends = await cache.aget(key)
+    if friends is None:
+        friends = await db_sync_to_async(load_friends)(user_id)
+        await cache.aset(key, friends, timeout=settings.FRIENDS_CACHE_TIMEOUT)
+    return friends
+
+
+def invalidate_friends(*user_ids):
+    """
+    Start a new cache version for every user whose friend list just changed.
+    Call it after the change is committed; lists cached under the old version
+    simply expire.
+    """
+    cache.set_many({friends_version_key(user_id): _new_version() for user_id in user_ids}, timeout=None)
@@ -1,21 +1,54 @@
+import logging
+import threading
+from functools import lru_cache
+
+from django.conf import settings
 from django.contrib.gis.geoip2 import GeoIP2
 
+logger = logging.getLogger(__name__)
+
+_geoip = None
+_geoip_lock = threading.Lock()
+
+
 def get_client_ip(request):
     """Extract the real IP address even behind a proxy."""
     x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
     if x_forwarded_for:
-        return x_forwarded_for.split(',')[0] 
+        return x_forwarded_for.split(',')[0]
     return request.META.get('REMOTE_ADDR')
 
 
+def get_geoip():
+    """
+    The process-wide GeoIP2 reader, opened on first use with the database
+    memory-mapped (MODE_AUTO: the maxminddb C extension's mmap reader when it is
+    installed, the pure Python one otherwise). None if the database could not be
+    opened; that is logged once and not retried until the process restarts.
+    """
+    global _geoip
+    if _geoip is None:
+        with _geoip_lock:
+            if _geoip is None:
+                try:
+                    _geoip = GeoIP2(cache=GeoIP2.MODE_AUTO)
+                except Exception as e:
+                    logger.warning(f"GeoIP database unavailable, locations will be Unknown: {e}")
+                    _geoip = False
+    return _geoip or None
 
-def get_location(ip):
-    """Get city and country from IP address using GeoIP2."""
+
+@lru_cache(maxsize=settings.GEOIP_CACHE_SIZE)
+def _lookup(ip):
     try:
-        geo = GeoIP2()
-        location = geo.city(ip)
-        city = location.get("city", "Unknown")
-        country = geo.country_name(ip)
-        return city, country
+        location = get_geoip().city(ip)
     except Exception:
         return "Unknown", "Unknown"
+    return location.get("city") or "Unknown", location.get("country_name") or "Unknown"
+
+
+def get_location(ip):
+    """Get city and country from IP address using GeoIP2."""
+    if not ip or get_geoip() is None:
+        return "Unknown", "Unknown"
+    return _lookup(ip)
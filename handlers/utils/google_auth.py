@@ -0,0 +1,130 @@
+import logging
+import re
+import threading
+import time
+
+import jwt
+import requests
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+GOOGLE_ISSUERS = ("accounts.google.com", "https://accounts.google.com")
+JWKS_CACHE_KEY = "google_jwks"
+DEFAULT_MAX_AGE = 60 * 60
+
+
+class InvalidGoogleToken(ValueError):
+    """Raised when a Google ID token does not verify."""
+
+
+def _max_age(response):
+    match = re.search(r"max-age=(\d+)", response.headers.get("Cache-Control", ""))
+    return int(match.group(1)) if match else DEFAULT_MAX_AGE
+
+
+class GoogleKeySet:
+    """
+    Google's ID token signing keys (GOOGLE_CERTS_URL), kept in process and in the
+    shared cache for as long as the response's Cache-Control max-age allows.
+
+    Keys are refreshed in a background thread once they are within
+    GOOGLE_JWKS_REFRESH_MARGIN seconds of expiry, so logins do not wait on Google;
+    only a cold start, fully expired keys or an unknown key id (after a rotation)
+    fetch in the request, the latter at most once per MIN_FETCH_INTERVAL seconds.
+    """
+
+    MIN_FETCH_INTERVAL = 60
+
+    def __init__(self):
+        self.keys = {}
+        self.expires_at = 0
+        self.fetched_at = 0
+        self.lock = threading.Lock()
+        self.refreshing = False
+        self.refreshing_lock = threading.Lock()
+        self.session = requests.Session()
+
+    def get_key(self, kid):
+        now = time.time()
+        if now >= self.expires_at:
+            try:
+                self.refresh()
+            except requests.RequestException as e:
+                if not self.keys:
+                    raise
+                logger.warning(f"Keeping expired Google signing keys, refresh failed: {e}")
+        elif kid not in self.keys and now - self.fetched_at >= self.MIN_FETCH_INTERVAL:
+            self.refresh(force=True)
+        elif now >= self.expires_at - settings.GOOGLE_JWKS_REFRESH_MARGIN:
+            self.refresh_in_background()
+
+        key = self.keys.get(kid)
+        if key is None:
+            raise InvalidGoogleToken(f"Unknown signing key {kid!r}")
+        return key
+
+    def refresh(self, force=False):
+        """Load the keys from the shared cache, or from Google if it is stale or `force` is set."""
+        with self.lock:
+            shared = None if force else cache.get(JWKS_CACHE_KEY)
+            if shared and shared["expires_at"] > time.time() + settings.GOOGLE_JWKS_REFRESH_MARGIN:
+                jwks, expires_at = shared["jwks"], shared["expires_at"]
+            else:
+                response = self.session.get(settings.GOOGLE_CERTS_URL, timeout=settings.GOOGLE_JWKS_TIMEOUT)
+                response.raise_for_status()
+                jwks, max_age = response.json(), _max_age(response)
+                expires_at = time.time() + max_age
+                cache.set(JWKS_CACHE_KEY, {"jwks": jwks, "expires_at": expires_at}, timeout=max_age)
+                self.fetched_at = time.time()
+
+            self.keys = {key.key_id: key.key for key in jwt.PyJWKSet.from_dict(jwks).keys}
+            self.expires_at = expires_at
+
+    def refresh_in_background(self):
+        with self.refreshing_lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.warning(f"Refreshing Google signing keys failed: {e}")
+            finally:
+                self.refreshing = False
+
+        threading.Thread(target=run, name="google-jwks-refresh", daemon=True).start()
+
+
+google_keys = GoogleKeySet()
+
+
+def verify_google_id_token(token):
+    """
+    Verify a Google ID token locally and return its claims (email, given_name,
+    family_name, picture, ...). Checks the signature, expiry, issuer, that the
+    audience is our SOCIAL_AUTH_GOOGLE_OAUTH2_KEY and that the email is verified.
+    """
+    try:
+        header = jwt.get_unverified_header(token)
+        key = google_keys.get_key(header.get("kid"))
+        claims = jwt.decode(
+            token,
+            key,
+            algorithms=["RS256"],
+            audience=settings.SOCIAL_AUTH_GOOGLE_OAUTH2_KEY,
+            options={"require": ["exp", "iat", "iss", "aud"]},
+        )
+    except jwt.PyJWTError as e:
+        raise InvalidGoogleToken(str(e))
+    except requests.RequestException as e:
+        raise InvalidGoogleToken(f"Google signing keys unavailable: {e}")
+
+    if claims.get("iss") not in GOOGLE_ISSUERS:
+        raise InvalidGoogleToken("Invalid issuer")
+    if claims.get("email") and not claims.get("email_verified"):
+        raise InvalidGoogleToken("Email not verified")
+    return claims
@@ -0,0 +1,27 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def notify_user(username, event):
+    """
+    Push a channel layer event to every live connection of `username` from sync code.
+    Delivery is best effort: a channel layer outage must not fail the REST request.
+    """
+    try:
+        async_to_sync(get_channel_layer().group_send)(f"user_{username}", event)
+    except Exception as e:
+        logger.warning(f"Could not notify {username}: {e}")
+
+
+def notify_friendship_changed(user, friend, status):
+    """Tell both users' open connections that their friendship was `accepted` or `removed`."""
+    for recipient, other in ((user, friend), (friend, user)):
+        notify_user(recipient.username, {
+            'type': 'friendship_changed',
+            'friend': other.username,
+            'friend_id': other.id,
+            'status': status,
+        })
@@ -0,0 +1,115 @@
+import base64
+import heapq
+from datetime import datetime
+from itertools import islice
+
+from django.conf import settings
+from django.db.models import Q, QuerySet
+
+
+class InvalidCursor(ValueError):
+    """Raised when a client sends a cursor we did not issue."""
+
+
+def encode_cursor(sent_at, pk):
+    """Build an opaque cursor from a message's (sent_at, id) position."""
+    raw = f"{sent_at.isoformat()}|{pk}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Return the (sent_at, id) pair stored in a cursor."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        sent_at, pk = base64.urlsafe_b64decode(padded.encode()).decode().split("|", 1)
+        return datetime.fromisoformat(sent_at), int(pk)
+    except (ValueError, TypeError):
+        raise InvalidCursor(f"Invalid cursor: {cursor!r}")
+
+
+def get_page_size(value, default=None, maximum=None):
+    """Parse a client supplied page size, falling back to the default and capping it."""
+    default = default or settings.CHAT_MESSAGES_PAGE_SIZE
+    maximum = maximum or settings.CHAT_MESSAGES_MAX_PAGE_SIZE
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(size, maximum))
+
+
+def conversation_querysets(queryset, user, friend):
+    """
+    The two directions of a conversation, for paginate_messages(). Each one is a
+    single (user, recipient) range of chat_pair_sent_idx; an OR of both would make
+    SQLite read and sort every message of the pair before applying the LIMIT.
+    """
+    return [
+        queryset.filter(user=user, recipient=friend),
+        queryset.filter(user=friend, recipient=user),
+    ]
+
+
+def _seek(querysets, descending, limit):
+    """The first `limit` rows of the merged querysets, one ordered index seek each."""
+    order = ("-sent_at", "-id") if descending else ("sent_at", "id")
+    branches = [list(queryset.order_by(*order)[:limit]) for queryset in querysets]
+    merged = heapq.merge(*branches, key=lambda row: (row.sent_at, row.id), reverse=descending)
+    return list(islice(merged, limit))
+
+
+def paginate_messages(querysets, before=None, after=None, limit=None):
+    """
+    Keyset pagination over chat messages ordered by (sent_at, id).
+
+    `querysets` is a queryset or a list of them whose rows do not overlap (see
+    conversation_querysets()); each is read with its own index seek and the
+    results are merged. Only one page (plus a single look-ahead row) is read per
+    queryset, so the cost does not depend on how long the conversation is. Items
+    are always returned newest first. `before` walks towards older messages,
+    `after` towards newer ones.
+    """
+    limit = limit or settings.CHAT_MESSAGES_PAGE_SIZE
+    if isinstance(querysets, QuerySet):
+        querysets = [querysets]
+
+    if after:
+        sent_at, pk = decode_cursor(after)
+        # The sent_at bound lets the index seek start at the cursor; the OR only
+        # breaks ties within that timestamp.
+        querysets = [
+            queryset.filter(sent_at__gte=sent_at).filter(Q(sent_at__gt=sent_at) | Q(id__gt=pk))
+            for queryset in querysets
+        ]
+        rows = _seek(querysets, descending=False, limit=limit + 1)
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        rows.reverse()
+    else:
+        if before:
+            sent_at, pk = decode_cursor(before)
+            querysets = [
+                queryset.filter(sent_at__lte=sent_at).filter(Q(sent_at__lt=sent_at) | Q(id__lt=pk))
+                for queryset in querysets
+            ]
+        rows = _seek(querysets, descending=True, limit=limit + 1)
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+    if rows:
+        newest, oldest = rows[0], rows[-1]
+        after_cursor = encode_cursor(newest.sent_at, newest.id)
+        # An `after` page always has older messages: the row the cursor points at.
+        before_cursor = encode_cursor(oldest.sent_at, oldest.id) if (has_more or after) else None
+    else:
+        after_cursor = after
+        before_cursor = None
+
+    return {
+        "items": rows,
+        "cursors": {
+            "before": before_cursor,
+            "after": after_cursor,
+        },
+        "has_more": has_more,
+    }
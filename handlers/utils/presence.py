@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import time
+from collections import Counter
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .redis_client import get_redis, get_async_redis
+
+logger = logging.getLogger(__name__)
+
+ONLINE = "Online"
+OFFLINE = "Offline"
+
+
+class Presence:
+    """
+    Multi-device presence kept in Redis.
+
+    Each user has a hash `presence:<username>` of {channel_name: last_heartbeat}. A
+    connection counts as live while its heartbeat is younger than PRESENCE_TTL;
+    older fields (connections of a crashed worker) are pruned on the next touch, and
+    the hash itself expires after PRESENCE_TTL without any heartbeat. Every update
+    is a single MULTI, so two devices connecting and disconnecting on different
+    workers always see each other's changes.
+    """
+
+    def key(self, username):
+        return f"presence:{username}"
+
+    def _live_count(self, connections, now):
+        ttl = settings.PRESENCE_TTL
+        return sum(1 for seen in connections.values() if now - float(seen) < ttl)
+
+    def _stale(self, connections, now):
+        ttl = settings.PRESENCE_TTL
+        return [channel for channel, seen in connections.items() if now - float(seen) >= ttl]
+
+    def announced_key(self, username):
+        return f"presence_announced:{username}"
+
+    def _touch_pipeline(self, redis, username, channel_name, now):
+        key = self.key(username)
+        pipe = redis.pipeline(transaction=True)
+        pipe.hset(key, channel_name, now)
+        pipe.expire(key, settings.PRESENCE_TTL)
+        # The announced status lives as long as the heartbeats that back it
+        pipe.expire(self.announced_key(username), settings.PRESENCE_TTL)
+        pipe.hgetall(key)
+        return pipe
+
+    def _remove_pipeline(self, redis, username, channel_name):
+        pipe = redis.pipeline(transaction=True)
+        pipe.hdel(self.key(username), channel_name)
+        pipe.hgetall(self.key(username))
+        return pipe
+
+    def _statuses_pipeline(self, redis, usernames):
+        pipe = redis.pipeline(transaction=False)
+        for username in usernames:
+            pipe.hvals(self.key(username))
+        return pipe
+
+    def _statuses(self, usernames, found, now):
+        ttl = settings.PRESENCE_TTL
+        return {
+            username: ONLINE if any(now - float(seen) < ttl for seen in heartbeats) else OFFLINE
+            for username, heartbeats in zip(usernames, found)
+        }
+
+    def touch(self, username, channel_name):
+        """Register or refresh a connection. Returns the user's live connection count."""
+        now = time.time()
+        redis = get_redis()
+        connections = self._touch_pipeline(redis, username, channel_name, now).execute()[-1]
+        stale = self._stale(connections, now)
+        if stale:
+            redis.hdel(self.key(username), *stale)
+        return self._live_count(connections, now)
+
+    def remove(self, username, channel_name):
+        """Drop a connection. Returns how many of the user's connections are still live."""
+        connections = self._remove_pipeline(get_redis(), username, channel_name).execute()[-1]
+        return self._live_count(connections, time.time())
+
+    def statuses(self, usernames):
+        """Online/Offline for many users with a single Redis round trip."""
+        usernames = list(usernames)
+        found = self._statuses_pipeline(get_redis(), usernames).execute()
+        return self._statuses(usernames, found, time.time())
+
+    def is_online(self, username):
+        return self.statuses([username])[username] == ONLINE
+
+    def announce(self, username, status):
+        """
+        Record the status friends were last told about. False if it is not a change.
+        The record expires PRESENCE_TTL seconds after the last heartbeat, so one left
+        behind by a worker that died mid-grace cannot suppress the next Online.
+        """
+        previous = get_redis().set(self.announced_key(username), status, ex=settings.PRESENCE_TTL, get=True)
+        return (previous.decode() if previous else OFFLINE) != status
+
+    async def atouch(self, username, channel_name):
+        now = time.time()
+        redis = get_async_redis()
+        connections = (await self._touch_pipeline(redis, username, channel_name, now).execute())[-1]
+        stale = self._stale(connections, now)
+        if stale:
+            await redis.hdel(self.key(username), *stale)
+        return self._live_count(connections, now)
+
+    async def aremove(self, username, channel_name):
+        connections = (await self._remove_pipeline(get_async_redis(), username, channel_name).execute())[-1]
+        return self._live_count(connections, time.time())
+
+    async def astatuses(self, usernames):
+        usernames = list(usernames)
+        found = await self._statuses_pipeline(get_async_redis(), usernames).execute()
+        return self._statuses(usernames, found, time.time())
+
+    async def ais_online(self, username):
+        return (await self.astatuses([username]))[username] == ONLINE
+
+    async def aannounce(self, username, status):
+        previous = await get_async_redis().set(self.announced_key(username), status, ex=settings.PRESENCE_TTL, get=True)
+        return (previous.decode() if previous else OFFLINE) != status
+
+
+class PresenceBroadcaster:
+    """
+    Per-worker debouncing and batching of the presence changes sent to friends.
+
+    A user is announced Offline only after PRESENCE_OFFLINE_GRACE seconds without a
+    live connection, so a reload or a flapping mobile link produces no event at all.
+    Changes are queued per recipient and sent every PRESENCE_BROADCAST_INTERVAL as a
+    single `friends_status_delta` event, however many friends changed in between.
+    `stats` counts delta events sent and per-friend notifications suppressed.
+    """
+
+    def __init__(self, presence):
+        self.presence = presence
+        self.offline_timers = {}
+        self.outbox = {}
+        self.flush_task = None
+        self.stats = Counter()
+
+    async def online(self, username, friends):
+        timer = self.offline_timers.pop(username, None)
+        if timer:
+            timer.cancel()
+
+        if await self.presence.aannounce(username, ONLINE):
+            self.queue(username, ONLINE, friends)
+        else:
+            self.stats["suppressed"] += len(friends)
+
+    async def offline(self, username, friends):
+        timer = self.offline_timers.pop(username, None)
+        if timer:
+            timer.cancel()
+        self.offline_timers[username] = asyncio.create_task(self.offline_after_grace(username, friends))
+
+    async def offline_after_grace(self, username, friends):
+        await asyncio.sleep(settings.PRESENCE_OFFLINE_GRACE)
+        self.offline_timers.pop(username, None)
+
+        # The user may have reconnected meanwhile, possibly on another worker.
+        if await self.presence.ais_online(username) or not await self.presence.aannounce(username, OFFLINE):
+            self.stats["suppressed"] += len(friends)
+            return
+        self.queue(username, OFFLINE, friends)
+
+    def queue(self, username, status, friends):
+        for friend_username in friends:
+            changes = self.outbox.setdefault(friend_username, {})
+            if username in changes:
+                self.stats["suppressed"] += 1
+            changes[username] = status
+
+        if self.outbox and self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(settings.PRESENCE_BROADCAST_INTERVAL)
+        self.flush_task = None
+        outbox, self.outbox = self.outbox, {}
+
+        channel_layer = get_channel_layer()
+        for recipient, changes in outbox.items():
+            try:
+                await channel_layer.group_send(
+                    f"user_{recipient}",
+                    {
+                        'type': 'friends_status_delta',
+                        'friends_statuses': changes,
+                    }
+                )
+                self.stats["sent"] += 1
+            except Exception as e:
+                logger.error(f"Presence broadcast to {recipient} failed: {e}")
+
+        logger.debug(f"Presence events sent={self.stats['sent']} suppressed={self.stats['suppressed']}")
+
+
+presence = Presence()
+presence_broadcaster = PresenceBroadcaster(presence)
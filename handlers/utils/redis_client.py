@@ -0,0 +1,25 @@
+import asyncio
+
+import redis
+import redis.asyncio
+from django.conf import settings
+
+_async_clients = {}
+_sync_client = None
+
+
+def get_redis():
+    """Process-wide client for the Redis instance shared with CACHES and the channel layer."""
+    global _sync_client
+    if _sync_client is None:
+        _sync_client = redis.Redis.from_url(settings.REDIS_URL)
+    return _sync_client
+
+
+def get_async_redis():
+    """asyncio client; connections belong to an event loop, so there is one client per loop."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = redis.asyncio.Redis.from_url(settings.REDIS_URL)
+    return client
@@ -0,0 +1,35 @@
+import json
+
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - falls back to DRF's json encoder
+    orjson = None
+
+ORJSON_OPTIONS = orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS if orjson else 0
+
+
+def dumps(data):
+    """Encode to compact JSON bytes the same way ORJSONRenderer does."""
+    if orjson is None:
+        return json.dumps(data, cls=JSONEncoder, separators=(',', ':')).encode()
+    return orjson.dumps(data, default=JSONEncoder().default, option=ORJSON_OPTIONS)
+
+
+class ORJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer backed by orjson. Datetimes are written the way DRF writes them
+    (ISO 8601, UTC as 'Z'); anything orjson does not know is handed to DRF's encoder.
+    Falls back to the stock renderer when orjson is missing or indented output is asked for.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or self.get_indent(accepted_media_type or "", renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+
+        if data is None:
+            return b''
+
+        return dumps(data)
@@ -0,0 +1,122 @@
+import asyncio
+import json
+import logging
+
+from django.conf import settings
+
+from .redis_client import get_redis, get_async_redis
+
+logger = logging.getLogger(__name__)
+
+TASKS = {}
+
+
+def task(name):
+    """
+    Register `async def fn(http, **kwargs)` as a background task. `http` is the worker's
+    shared httpx.AsyncClient; kwargs are whatever was passed to enqueue() and must be
+    JSON serializable.
+    """
+    def register(fn):
+        TASKS[name] = fn
+        return fn
+    return register
+
+
+def enqueue(name, **kwargs):
+    """
+    Queue a task for `python manage.py run_tasks`. Best effort: if Redis is down the
+    task is dropped and logged, the calling request still succeeds.
+    """
+    record = json.dumps({"task": name, "kwargs": kwargs, "attempts": 0})
+    try:
+        get_redis().rpush(settings.TASK_QUEUE_KEY, record)
+    except Exception as e:
+        logger.error(f"Could not queue task {name}: {e}")
+
+
+async def download(http, url, max_bytes, content_type=None):
+    """
+    GET `url` into memory with the worker's client. Raises ValueError if the body is
+    larger than `max_bytes` (without reading past it) or not of `content_type`.
+    """
+    async with http.stream("GET", url) as response:
+        response.raise_for_status()
+        if content_type and not response.headers.get("Content-Type", "").startswith(content_type):
+            raise ValueError(f"Unexpected content type {response.headers.get('Content-Type')!r}")
+        if int(response.headers.get("Content-Length") or 0) > max_bytes:
+            raise ValueError(f"Download larger than {max_bytes} bytes")
+
+        content = bytearray()
+        async for chunk in response.aiter_bytes():
+            content += chunk
+            if len(content) > max_bytes:
+                raise ValueError(f"Download larger than {max_bytes} bytes")
+    return bytes(content)
+
+
+class TaskWorker:
+    """
+    Pops tasks from the Redis list TASK_QUEUE_KEY and runs up to
+    TASK_WORKER_CONCURRENCY of them at once on one event loop, sharing one pooled
+    HTTP client. A failed task is queued again until it has run TASK_MAX_ATTEMPTS
+    times. A task being run when the worker dies is lost. `transport` is passed to
+    the HTTP client (an httpx.MockTransport in tests).
+    """
+
+    def __init__(self, burst=False, transport=None):
+        self.burst = burst
+        self.transport = transport
+        self.semaphore = asyncio.Semaphore(settings.TASK_WORKER_CONCURRENCY)
+        self.running = set()
+
+    async def run(self):
+        import httpx
+
+        redis = get_async_redis()
+        limits = httpx.Limits(max_connections=settings.TASK_WORKER_CONCURRENCY)
+        async with httpx.AsyncClient(timeout=settings.TASK_HTTP_TIMEOUT, limits=limits, follow_redirects=True,
+                                     transport=self.transport) as http:
+            while True:
+                await self.semaphore.acquire()
+                if self.burst:
+                    record = await redis.lpop(settings.TASK_QUEUE_KEY)
+                else:
+                    popped = await redis.blpop([settings.TASK_QUEUE_KEY], timeout=5)
+                    record = popped[1] if popped else None
+
+                if record is None:
+                    self.semaphore.release()
+                    if self.burst:
+                        if not self.running:
+                            break
+                        # Running tasks may queue retries
+                        await asyncio.gather(*self.running)
+                    continue
+
+                job = asyncio.create_task(self.execute(http, record))
+                self.running.add(job)
+                job.add_done_callback(self.running.discard)
+
+            if self.running:
+                await asyncio.gather(*self.running)
+
+    async def execute(self, http, record):
+        try:
+            job = json.loads(record)
+            fn = TASKS.get(job["task"])
+            if fn is None:
+                logger.error(f"Unknown task {job['task']}")
+                return
+
+            try:
+                await fn(http, **job["kwargs"])
+            except Exception as e:
+                job["attempts"] += 1
+                if job["attempts"] >= settings.TASK_MAX_ATTEMPTS:
+                    logger.error(f"Task {job['task']} failed for good after {job['attempts']} attempts: {e}")
+                    return
+                logger.warning(f"Task {job['task']} failed, retrying: {e}")
+                await get_async_redis().rpush(settings.TASK_QUEUE_KEY, json.dumps(job))
+        finally:
+            self.semaphore.release()
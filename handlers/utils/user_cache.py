@@ -0,0 +1,78 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+User = get_user_model()
+
+
+def user_cache_key(user_id):
+    # v2: entries no longer include the password column, so the cached tuples have
+    # a different layout than the ones still expiring under the old key
+    return f"auth_user_v2_{user_id}"
+
+
+class UserCache:
+    """
+    Users resolved by id for authentication, without a query on a warm cache.
+
+    Lookups go through a small per-process LRU (USER_CACHE_LOCAL_SIZE entries, kept
+    USER_CACHE_LOCAL_TTL seconds) in front of the shared cache (USER_CACHE_TIMEOUT
+    seconds). Only the user's column values are stored, without the password hash;
+    every lookup builds a fresh instance, so requests never share a User object.
+    Saving or deleting a user invalidates both levels here; other processes drop
+    their local copy once it is USER_CACHE_LOCAL_TTL seconds old.
+    """
+
+    def __init__(self):
+        self.local = OrderedDict()
+        self.lock = threading.Lock()
+        # The password hash is not needed to authenticate a token and must not be
+        # copied into Redis; it is left deferred on the instances built here.
+        self.field_names = [field.attname for field in User._meta.concrete_fields if field.attname != "password"]
+
+    def get(self, user_id):
+        """The user with `user_id`, or None if there is no such user."""
+        # Token claims carry the id as a string
+        user_id = User._meta.pk.to_python(user_id)
+        values = self._get_local(user_id)
+        if values is None:
+            values = cache.get(user_cache_key(user_id))
+            if values is None:
+                values = User.objects.filter(pk=user_id).values_list(*self.field_names).first()
+                if values is None:
+                    return None
+                cache.set(user_cache_key(user_id), values, timeout=settings.USER_CACHE_TIMEOUT)
+            self._set_local(user_id, values)
+        return User.from_db(DEFAULT_DB_ALIAS, self.field_names, values)
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.local.pop(user_id, None)
+        cache.delete(user_cache_key(user_id))
+
+    def _get_local(self, user_id):
+        with self.lock:
+            entry = self.local.get(user_id)
+            if entry is None:
+                return None
+            expires, values = entry
+            if expires < time.monotonic():
+                del self.local[user_id]
+                return None
+            self.local.move_to_end(user_id)
+            return values
+
+    def _set_local(self, user_id, values):
+        with self.lock:
+            self.local[user_id] = (time.monotonic() + settings.USER_CACHE_LOCAL_TTL, values)
+            self.local.move_to_end(user_id)
+            while len(self.local) > settings.USER_CACHE_LOCAL_SIZE:
+                self.local.popitem(last=False)
+
+
+user_cache = UserCache()
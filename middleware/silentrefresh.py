@@ -1,5 +1,4 @@
 from django.http import JsonResponse
-import jwt
 from datetime import datetime, timezone
 from django.conf import settings
 from django.utils.deprecation import MiddlewareMixin
@@ -13,6 +12,9 @@ class SilentRefreshJwtMiddleware(MiddlewareMixin):
       - refresh token is valid
 
     Sets new access token cookie and updates request.META for DRF authentication.
+
+    This is the only place the access cookie is decoded: the validated token (or the
+    refreshed one) is left on `request.jwt_access_token` for CookieJWTAuthentication.
     """
 
     ACCESS_COOKIE_NAME = "access_token"
@@ -23,32 +25,34 @@ class SilentRefreshJwtMiddleware(MiddlewareMixin):
         access_token = request.COOKIES.get(self.ACCESS_COOKIE_NAME)
         refresh_token = request.COOKIES.get(self.REFRESH_COOKIE_NAME)
 
-        if not refresh_token:
+        if not access_token and not refresh_token:
             return None  # no tokens at all — user not authenticated
 
-        # If access token missing, try refresh immediately
-        if not access_token:
-            self._try_refresh(request, refresh_token)
+        # Validate the access cookie once; an expired or invalid one counts as missing
+        request.jwt_access_token = None
+        if access_token:
+            try:
+                request.jwt_access_token = AccessToken(access_token)
+            except TokenError:
+                pass
+
+        if not refresh_token:
             return None
 
-        try:
-            decoded = jwt.decode(
-                access_token,
-                settings.SIMPLE_JWT.get("SIGNING_KEY", settings.SECRET_KEY),
-                algorithms=[settings.SIMPLE_JWT.get("ALGORITHM", "HS256")],
-                options={"verify_exp": False}
-            )
-            exp_ts = decoded.get("exp")
-            if not exp_ts:
-                return None
+        # If access token missing or expired, try refresh immediately
+        token = request.jwt_access_token
+        if token is None:
+            self._try_refresh(request, refresh_token)
+            return None
 
-            exp_dt = datetime.fromtimestamp(exp_ts, tz=timezone.utc)
-            now = datetime.now(timezone.utc)
+        exp_ts = token.get("exp")
+        if not exp_ts:
+            return None
 
-            if exp_dt <= now or (exp_dt - now).total_seconds() < self.REFRESH_THRESHOLD:
-                self._try_refresh(request, refresh_token)
+        exp_dt = datetime.fromtimestamp(exp_ts, tz=timezone.utc)
+        now = datetime.now(timezone.utc)
 
-        except jwt.InvalidTokenError:
+        if (exp_dt - now).total_seconds() < self.REFRESH_THRESHOLD:
             self._try_refresh(request, refresh_token)
 
         return None
@@ -56,7 +60,9 @@ class SilentRefreshJwtMiddleware(MiddlewareMixin):
     def _try_refresh(self, request, refresh_token_str):
         try:
             refresh = RefreshToken(refresh_token_str)
-            new_access = str(refresh.access_token)
+            access_token = refresh.access_token
+            new_access = str(access_token)
+            request.jwt_access_token = access_token
             request._new_access_token = new_access
             request.META["HTTP_AUTHORIZATION"] = f"Bearer {new_access}"
 